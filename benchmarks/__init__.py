@@ -0,0 +1,8 @@
+"""
+Benchmarks for the Order Service
+
+Each benchmark is a module that can be run with:
+  python -m benchmarks.<module> --help
+
+They run against a local SQLite database unless DATABASE_URI is set.
+"""
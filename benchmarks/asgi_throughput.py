@@ -0,0 +1,134 @@
+"""
+ASGI Throughput Benchmark
+
+Serves the same SQLite database with the two serving modes and drives
+both with the same concurrent mix of single Order reads and filtered list
+pages (the Order cache is disabled, so every request reaches the database):
+  sync  - gunicorn --workers=1 service:app, as in the Procfile
+  async - uvicorn --workers=1 service.asgi:app
+
+A local SQLite file answers in microseconds, which leaves nothing for the
+async mode to overlap; --latency-ms adds a delay to every database round
+trip (see slow_database.py) to stand in for a database across a network.
+For every concurrency it reports the requests per second and the p50 and
+p99 latencies:
+  python -m benchmarks.asgi_throughput --concurrency 1 10 50 --latency-ms 5
+"""
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'orders-asgi-bench.db')
+
+# the servers are run from the bin directory of this Python
+BIN = os.path.dirname(sys.executable)
+
+SERVERS = {
+    'sync': [os.path.join(BIN, 'gunicorn'), '--workers=1', '--log-level=warning',
+             '--bind=127.0.0.1:{port}', 'benchmarks.slow_database:wsgi_app'],
+    'async': [os.path.join(BIN, 'uvicorn'), '--workers=1', '--log-level=warning',
+              '--port={port}', 'benchmarks.slow_database:asgi_app'],
+}
+
+def seed(rows, customers):
+    """ Creates the schema and inserts rows Orders with executemany """
+    os.environ['DATABASE_URI'] = DATABASE_URI
+    from service import app                  # pylint: disable=import-outside-toplevel
+    from service.models import Order, db     # pylint: disable=import-outside-toplevel
+    Order.init_db(app)
+    db.drop_all()
+    db.create_all()
+    db.engine.execute(Order.__table__.insert(), [
+        {'uuid': '{:032x}'.format(n), 'customer_id': n % customers, 'product_id': n % 100,
+         'price': 1 + n % 100, 'quantity': 1 + n % 10, 'status': 'In Progress', 'version': 1}
+        for n in range(rows)
+    ])
+
+def free_port():
+    """ Returns a TCP port that nothing listens on """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start(mode, latency_ms):
+    """ Starts a server and returns the process and its base URL """
+    port = free_port()
+    env = dict(os.environ, DATABASE_URI=DATABASE_URI, CACHE_BACKEND='none',
+               DB_LATENCY_MS=str(latency_ms))
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + '/stats/cache', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('The {} server did not start'.format(mode))
+
+def client(url, rows, customers, deadline):
+    """ Sends requests until the deadline and returns their latencies """
+    session = requests.Session()
+    latencies = []
+    while time.perf_counter() < deadline:
+        if random.random() < 0.5:
+            path = '/orders/{}'.format(random.randint(1, rows))
+        else:
+            path = '/orders?customer_id={}&status=In%20Progress&limit=20'.format(
+                random.randrange(customers))
+        start_time = time.perf_counter()
+        resp = session.get(url + path)
+        latencies.append(time.perf_counter() - start_time)
+        resp.raise_for_status()
+    return latencies
+
+def measure(url, concurrency, seconds, rows, customers):
+    """ Returns the requests per second, p50 and p99 latency (ms) of a load """
+    deadline = time.perf_counter() + seconds
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: client(url, rows, customers, deadline),
+                                range(concurrency)))
+    latencies = sorted(latency for result in results for latency in result)
+    def percentile(fraction):
+        return 1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+    return len(latencies) / seconds, percentile(0.5), percentile(0.99)
+
+def main(argv=None):
+    """ Runs the benchmark and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args(argv)
+
+    seed(args.rows, args.customers)
+    print('database latency: {} ms per round trip'.format(args.latency_ms))
+    print('{:>6}{:>12}{:>10}{:>10}{:>10}'.format('mode', 'concurrency', 'req/sec',
+                                                  'p50 ms', 'p99 ms'))
+    for mode in SERVERS:
+        process, url = start(mode, args.latency_ms)
+        try:
+            measure(url, 1, 1, args.rows, args.customers)    # warm up
+            for concurrency in args.concurrency:
+                rate, p50, p99 = measure(url, concurrency, args.seconds, args.rows,
+                                         args.customers)
+                print('{:>6}{:>12}{:>10,.0f}{:>10.1f}{:>10.1f}'.format(mode, concurrency,
+                                                                       rate, p50, p99))
+        finally:
+            process.terminate()
+            process.wait()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Gunicorn Scaling Benchmark
+
+Runs the service under gunicorn_config.py with different numbers of
+workers and threads and drives each setup with the same concurrent load
+as asgi_throughput (the Order cache is disabled):
+  1x1 sync - one sync worker, the old Procfile
+  2x1 sync - two sync workers
+  1x8      - one gthread worker with 8 threads
+  auto     - the workers and threads chosen by gunicorn_config.py
+
+  python -m benchmarks.gunicorn_scaling --concurrency 50 --latency-ms 5
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import requests
+from benchmarks.asgi_throughput import BIN, DATABASE_URI, seed, free_port, measure
+
+SETUPS = {
+    '1x1 sync': {'WEB_CONCURRENCY': '1', 'WORKER_THREADS': '1', 'WORKER_CLASS': 'sync'},
+    '2x1 sync': {'WEB_CONCURRENCY': '2', 'WORKER_THREADS': '1', 'WORKER_CLASS': 'sync'},
+    '1x8': {'WEB_CONCURRENCY': '1', 'WORKER_THREADS': '8'},
+    'auto': {},
+}
+
+def start(setup, latency_ms):
+    """ Starts gunicorn with a setup and returns the process and its base URL """
+    port = free_port()
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('WEB_CONCURRENCY', 'WORKER_THREADS', 'WORKER_CLASS')}
+    env.update(SETUPS[setup], DATABASE_URI=DATABASE_URI, CACHE_BACKEND='none',
+               DB_LATENCY_MS=str(latency_ms), PORT=str(port))
+    process = subprocess.Popen([os.path.join(BIN, 'gunicorn'), '--config=gunicorn_config.py',
+                                '--log-level=warning', 'benchmarks.slow_database:wsgi_app'],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + '/stats/cache', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('gunicorn did not start with {}'.format(setup))
+
+def main(argv=None):
+    """ Runs the benchmark and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--setups', nargs='+', default=list(SETUPS), choices=list(SETUPS))
+    args = parser.parse_args(argv)
+
+    seed(args.rows, args.customers)
+    print('database latency: {} ms per round trip'.format(args.latency_ms))
+    print('{:>10}{:>12}{:>10}{:>10}{:>10}'.format('setup', 'concurrency', 'req/sec',
+                                                   'p50 ms', 'p99 ms'))
+    for setup in args.setups:
+        process, url = start(setup, args.latency_ms)
+        try:
+            measure(url, 1, 1, args.rows, args.customers)    # warm up
+            for concurrency in args.concurrency:
+                rate, p50, p99 = measure(url, concurrency, args.seconds, args.rows,
+                                         args.customers)
+                print('{:>10}{:>12}{:>10,.0f}{:>10.1f}{:>10.1f}'.format(setup, concurrency,
+                                                                        rate, p50, p99))
+        finally:
+            process.terminate()
+            process.wait()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Index Lookup Benchmark
+
+Measures the latency of the Order lookups before and after the secondary
+indexes are added by the schema migrations.
+
+The order table is filled without its indexes, the lookups are timed,
+then the migrations are applied in place and the lookups are timed again:
+  python -m benchmarks.index_lookup --rows 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+DEFAULT_URI = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'orders-bench.db')
+os.environ.setdefault('DATABASE_URI', DEFAULT_URI)
+
+from service import app                    # pylint: disable=wrong-import-position
+from service.models import Order, db       # pylint: disable=wrong-import-position
+from service.migrations import schema_version, upgrade  # pylint: disable=wrong-import-position
+
+CUSTOMERS = 10000
+PRODUCTS = 1000
+STATUSES = ['In Progress', 'Delivered', 'Cancelled']
+
+def seed(rows, batch=10000):
+    """ Inserts rows Orders with executemany, without any indexes """
+    db.drop_all()
+    db.create_all()
+    for index in Order.__table__.indexes:
+        index.drop(db.engine)
+    db.engine.execute(schema_version.delete())
+    for start in range(0, rows, batch):
+        db.engine.execute(Order.__table__.insert(), [
+            {'uuid': '{:032x}'.format(n),
+             'customer_id': n % CUSTOMERS,
+             'product_id': n % PRODUCTS,
+             'price': 1 + n % 100,
+             'quantity': 1 + n % 10,
+             'status': STATUSES[n % len(STATUSES)]}
+            for n in range(start, min(start + batch, rows))
+        ])
+
+def time_lookups(rows, lookups):
+    """ Returns the mean latency in milliseconds of each kind of lookup """
+    rng = random.Random(42)
+    queries = {
+        'find': lambda: Order.find(rng.randrange(1, rows + 1)),
+        'find_by_customer': lambda: Order.paginate_rows(
+            Order.find_by_customer(rng.randrange(CUSTOMERS)), limit=20),
+        'find_by_product': lambda: Order.paginate_rows(
+            Order.find_by_product(rng.randrange(PRODUCTS)), limit=20),
+        'find_by_uuid': lambda: Order.query.filter(
+            Order.uuid == '{:032x}'.format(rng.randrange(rows))).first(),
+    }
+    results = {}
+    for name, query in queries.items():
+        start = time.perf_counter()
+        for _ in range(lookups):
+            query()
+            db.session.remove()
+        results[name] = (time.perf_counter() - start) * 1000 / lookups
+    return results
+
+def main(argv=None):
+    """ Runs the benchmark and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel('WARNING')
+    Order.logger.setLevel('WARNING')
+    Order.init_db(app)
+    print('Seeding {} orders into {}'.format(args.rows, app.config['SQLALCHEMY_DATABASE_URI']))
+    seed(args.rows)
+    before = time_lookups(args.rows, args.lookups)
+    start = time.perf_counter()
+    upgrade(db.engine)
+    migration_seconds = time.perf_counter() - start
+    after = time_lookups(args.rows, args.lookups)
+
+    print('Migration applied in {:.1f}s'.format(migration_seconds))
+    print('{:<20}{:>14}{:>14}{:>10}'.format('lookup', 'before (ms)', 'after (ms)', 'speedup'))
+    for name in before:
+        print('{:<20}{:>14.3f}{:>14.3f}{:>9.0f}x'.format(
+            name, before[name], after[name], before[name] / after[name]))
+    db.drop_all()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+List Serialization Benchmark
+
+Compares the two ways of turning a page of Orders into a JSON response:
+  orm  - Order.query, Order.serialize and jsonify (the old list path)
+  core - Order.paginate_rows and encoding.encode_rows (the fast path)
+
+For every page size it reports the rows per second and the peak memory
+allocated while building one response:
+  python -m benchmarks.list_serialization --sizes 1000 10000 100000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+DEFAULT_URI = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'orders-bench.db')
+os.environ.setdefault('DATABASE_URI', DEFAULT_URI)
+
+from flask import jsonify                  # pylint: disable=wrong-import-position
+from service import app, encoding          # pylint: disable=wrong-import-position
+from service.models import Order, db       # pylint: disable=wrong-import-position
+
+def seed(rows, batch=10000):
+    """ Inserts rows Orders with executemany """
+    db.drop_all()
+    db.create_all()
+    for start in range(0, rows, batch):
+        db.engine.execute(Order.__table__.insert(), [
+            {'uuid': '{:032x}'.format(n), 'customer_id': n % 1000, 'product_id': n % 100,
+             'price': 1 + n % 100, 'quantity': 1 + n % 10, 'status': 'In Progress'}
+            for n in range(start, min(start + batch, rows))
+        ])
+
+def orm_path(size):
+    """ Builds a list response the way the list endpoints used to """
+    orders = Order.query.order_by(Order.id).limit(size).all()
+    return jsonify([order.serialize() for order in orders]).get_data()
+
+def core_path(size):
+    """ Builds a list response with the projection fast path """
+    rows, _ = Order.paginate_rows(limit=size)
+    return encoding.encode_rows(Order.column_names(), rows)
+
+def measure(path, size, repeat):
+    """ Returns the rows per second and the peak memory (MiB) of a path """
+    with app.test_request_context():
+        path(size)      # warm up
+        db.session.remove()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            path(size)
+            db.session.remove()
+        seconds = (time.perf_counter() - start) / repeat
+        tracemalloc.start()
+        path(size)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.session.remove()
+    return size / seconds, peak / 2 ** 20
+
+def main(argv=None):
+    """ Runs the benchmark and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel('WARNING')
+    Order.logger.setLevel('WARNING')
+    Order.init_db(app)
+    seed(max(args.sizes))
+    print('JSON encoder: {}'.format(encoding.ENCODER))
+    print('{:>8}{:>6}{:>14}{:>12}'.format('rows', 'path', 'rows/sec', 'peak MiB'))
+    for size in args.sizes:
+        for name, path in (('orm', orm_path), ('core', core_path)):
+            rate, peak = measure(path, size, args.repeat)
+            print('{:>8}{:>6}{:>14,.0f}{:>12.1f}'.format(size, name, rate, peak))
+    db.drop_all()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""
+Load Test of the REST API
+
+Seeds a database with Orders made by tests/order_factory.py, serves it
+with gunicorn_config.py (or uses a service that is already running) and
+drives every route concurrently with a weighted mix of reads and writes.
+Reports the requests per second and the p50, p95 and p99 latencies of
+each operation and of the whole mix, and writes them as JSON so that two
+commits can be compared:
+
+  python -m benchmarks.loadtest --rows 100000 --concurrency 20 --output base.json
+  git checkout my-branch
+  python -m benchmarks.loadtest --rows 100000 --concurrency 20 --output new.json
+  python -m benchmarks.loadtest --compare base.json new.json
+
+The database is a SQLite file unless DATABASE_URI names another one; the
+workload is the same for a given --seed. --compare exits with 1 when an
+operation failed more often, or got slower (p95) or slower to serve
+(req/sec) by more than --threshold percent; operations measured fewer than --min-requests times
+are shown but not judged, their percentiles are mostly noise.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.asgi_throughput import BIN, free_port
+
+DATABASE_URI = os.environ.get('DATABASE_URI', 'sqlite:///' + os.path.join(
+    os.path.abspath(os.sep), 'tmp', 'orders-loadtest.db'))
+PERCENTILES = (50, 95, 99)
+# the Orders created by the load are on customers after the seeded ones
+NEW_CUSTOMERS = 1000
+
+######################################################################
+#  S E E D I N G
+######################################################################
+def seed(rows, customers, products, random_seed):
+    """ Creates the schema and inserts rows Orders made by the OrderFactory """
+    os.environ['DATABASE_URI'] = DATABASE_URI
+    from service import app                     # pylint: disable=import-outside-toplevel
+    from service.models import Order, db        # pylint: disable=import-outside-toplevel
+    from tests.order_factory import OrderFactory  # pylint: disable=import-outside-toplevel
+    Order.init_db(app)
+    db.drop_all()
+    db.create_all()
+    rand = random.Random(random_seed)
+    batch = []
+    for _ in range(rows):
+        order = OrderFactory.build(customer_id=rand.randrange(customers),
+                                   product_id=rand.randrange(products),
+                                   price=rand.randint(1, 500), quantity=rand.randint(1, 10))
+        data = order.serialize()
+        del data['id']
+        data['version'] = 1
+        batch.append(data)
+        if len(batch) == 10000:
+            db.engine.execute(Order.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.engine.execute(Order.__table__.insert(), batch)
+    db.session.remove()
+
+def start(workers, threads):
+    """ Starts gunicorn with gunicorn_config.py and returns the process and its URL """
+    port = free_port()
+    env = dict(os.environ, DATABASE_URI=DATABASE_URI, PORT=str(port))
+    if workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+    if threads:
+        env['WORKER_THREADS'] = str(threads)
+    process = subprocess.Popen([os.path.join(BIN, 'gunicorn'), '--config=gunicorn_config.py',
+                                '--log-level=warning', 'service:app'],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + '/health/ready', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+######################################################################
+#  W O R K L O A D
+######################################################################
+def new_order(rand, customers):
+    """ Returns the body of an Order to create, with a uuid no other run used """
+    return {'customer_id': customers + rand.randrange(NEW_CUSTOMERS),
+            'product_id': rand.randrange(100), 'price': rand.randint(1, 500),
+            'quantity': rand.randint(1, 10), 'status': 'In Progress',
+            'uuid': str(uuid.uuid4())}
+
+class Client(object):
+    """ One simulated user that sends a weighted mix of requests """
+
+    def __init__(self, url, args, random_seed):
+        self.url = url
+        self.args = args
+        self.rand = random.Random(random_seed)
+        self.session = requests.Session()
+        self.created = []    # the ids this client created, to update and delete
+
+    def some_order(self):
+        """ Returns the id of a seeded Order """
+        return self.rand.randint(1, self.args.rows)
+
+    def some_customer(self):
+        """ Returns a seeded customer """
+        return self.rand.randrange(self.args.customers)
+
+    def get_order(self):
+        """ Reads a seeded Order """
+        return self.session.get('{}/orders/{}'.format(self.url, self.some_order())), (200,)
+
+    def list_orders(self):
+        """ Reads a filtered and sorted page of Orders """
+        path = '{}/orders?customer_id={}&status=In%20Progress&sort=price&limit=20'.format(
+            self.url, self.some_customer())
+        return self.session.get(path), (200,)
+
+    def list_by_customer(self):
+        """ Reads a page of the Orders of a customer """
+        path = '{}/orders/customers/{}?limit=20'.format(self.url, self.some_customer())
+        return self.session.get(path), (200,)
+
+    def list_by_product(self):
+        """ Reads a page of the Orders of a product """
+        path = '{}/orders/products/{}?limit=20'.format(self.url, self.rand.randrange(100))
+        return self.session.get(path), (200,)
+
+    def customer_summary(self):
+        """ Reads the totals of a customer """
+        path = '{}/orders/customers/{}/summary'.format(self.url, self.some_customer())
+        return self.session.get(path), (200,)
+
+    def product_summary(self):
+        """ Reads the totals of a product """
+        path = '{}/orders/products/{}/summary'.format(self.url, self.rand.randrange(100))
+        return self.session.get(path), (200,)
+
+    def create_order(self):
+        """ Creates an Order """
+        resp = self.session.post(self.url + '/orders',
+                                 json=new_order(self.rand, self.args.customers))
+        if resp.status_code == 201:
+            self.created.append(resp.json()['id'])
+        return resp, (201,)
+
+    def bulk_create(self):
+        """ Creates 10 Orders at once """
+        orders = [new_order(self.rand, self.args.customers) for _ in range(10)]
+        resp = self.session.post(self.url + '/orders/bulk', json=orders)
+        if resp.status_code == 201:
+            self.created.extend(result['order']['id'] for result in resp.json()['results'])
+        return resp, (201,)
+
+    def update_order(self):
+        """ Reads and updates an Order this client created """
+        if not self.created:
+            return self.create_order()
+        order_id = self.rand.choice(self.created)
+        order = self.session.get('{}/orders/{}'.format(self.url, order_id)).json()
+        order['quantity'] = self.rand.randint(1, 10)
+        return self.session.put('{}/orders/{}'.format(self.url, order_id), json=order), (200,)
+
+    def cancel_order(self):
+        """ Cancels a seeded Order """
+        # a seeded Order that was already cancelled answers 409
+        path = '{}/orders/{}/cancel'.format(self.url, self.some_order())
+        return self.session.put(path), (200, 409)
+
+    def bulk_cancel(self):
+        """ Cancels the Orders of a customer the load created """
+        customer = self.args.customers + self.rand.randrange(NEW_CUSTOMERS)
+        resp = self.session.put(self.url + '/orders/bulk/cancel',
+                                json={'customer_id': customer})
+        return resp, (200,)
+
+    def delete_order(self):
+        """ Deletes an Order this client created """
+        if not self.created:
+            return self.create_order()
+        order_id = self.created.pop(self.rand.randrange(len(self.created)))
+        return self.session.delete('{}/orders/{}'.format(self.url, order_id)), (204,)
+
+    def run(self, deadline):
+        """ Sends requests until the deadline and returns the latencies of each operation """
+        operations = list(WORKLOAD)
+        weights = [WORKLOAD[name] for name in operations]
+        latencies = {name: [] for name in operations}
+        errors = {name: 0 for name in operations}
+        while time.perf_counter() < deadline:
+            name = self.rand.choices(operations, weights)[0]
+            start_time = time.perf_counter()
+            try:
+                resp, expected = getattr(self, name)()
+                failed = resp.status_code not in expected
+            except requests.RequestException:
+                failed = True
+            latencies[name].append(time.perf_counter() - start_time)
+            errors[name] += failed
+        return latencies, errors
+
+# the operations of a client and their relative weights: mostly reads
+WORKLOAD = {
+    'get_order': 30,
+    'list_orders': 15,
+    'list_by_customer': 10,
+    'list_by_product': 5,
+    'customer_summary': 5,
+    'product_summary': 5,
+    'create_order': 10,
+    'bulk_create': 2,
+    'update_order': 8,
+    'cancel_order': 4,
+    'bulk_cancel': 1,
+    'delete_order': 5,
+}
+
+######################################################################
+#  R E P O R T I N G
+######################################################################
+def percentile(latencies, percent):
+    """ Returns a percentile of sorted latencies in milliseconds (nearest rank) """
+    if not latencies:
+        return None
+    rank = max(1, -(-percent * len(latencies) // 100))
+    return round(1000 * latencies[int(rank) - 1], 3)
+
+def statistics(latencies, errors, seconds):
+    """ Returns the count, errors, rate and latency percentiles of some requests """
+    latencies = sorted(latencies)
+    result = {'requests': len(latencies), 'errors': errors,
+              'rps': round(len(latencies) / seconds, 1)}
+    for percent in PERCENTILES:
+        result['p{}_ms'.format(percent)] = percentile(latencies, percent)
+    return result
+
+def measure(url, args):
+    """ Runs the workload on concurrent clients and returns the statistics """
+    deadline = time.perf_counter() + args.seconds
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda n: Client(url, args, args.seed + n).run(deadline),
+                                range(args.concurrency)))
+    operations = {}
+    for name in WORKLOAD:
+        operations[name] = statistics([latency for latencies, _ in results
+                                       for latency in latencies[name]],
+                                      sum(errors[name] for _, errors in results), args.seconds)
+    total = statistics([latency for latencies, _ in results
+                        for name in WORKLOAD for latency in latencies[name]],
+                       sum(sum(errors.values()) for _, errors in results), args.seconds)
+    return {'total': total, 'operations': operations}
+
+def git_commit():
+    """ Returns the commit being measured, or None outside of a git checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_table(report):
+    """ Prints the statistics of a report """
+    print('{:>18}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+        'operation', 'requests', 'errors', 'req/sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+    rows = list(report['operations'].items()) + [('total', report['total'])]
+    for name, stats in rows:
+        if stats['requests']:
+            print('{:>18}{:>10}{:>8}{:>10,.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                name, stats['requests'], stats['errors'], stats['rps'],
+                stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+
+def compare(base, new, threshold, min_requests):
+    """ Prints the changes between two reports and returns the regressions """
+    regressions = []
+    print('{:>18}{:>12}{:>12}{:>9}{:>12}{:>12}{:>9}'.format(
+        'operation', 'base p95', 'new p95', 'change', 'base rps', 'new rps', 'change'))
+    names = [name for name in new['operations'] if name in base['operations']] + ['total']
+    for name in names:
+        old = base['total'] if name == 'total' else base['operations'][name]
+        now = new['total'] if name == 'total' else new['operations'][name]
+        if not old['requests'] or not now['requests']:
+            continue
+        latency = 100.0 * (now['p95_ms'] - old['p95_ms']) / old['p95_ms']
+        rate = 100.0 * (now['rps'] - old['rps']) / old['rps']
+        print('{:>18}{:>12.1f}{:>12.1f}{:>+8.1f}%{:>12,.1f}{:>12,.1f}{:>+8.1f}%'.format(
+            name, old['p95_ms'], now['p95_ms'], latency, old['rps'], now['rps'], rate))
+        # too few requests to tell a regression from noise
+        if min(old['requests'], now['requests']) < min_requests:
+            continue
+        if latency > threshold or -rate > threshold or \
+                now['errors'] / now['requests'] > old['errors'] / old['requests']:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    """ Runs the load test, or compares the reports of two runs """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, help='gunicorn workers (default from config)')
+    parser.add_argument('--threads', type=int, help='threads per worker (default from config)')
+    parser.add_argument('--url', help='load a service that is already running (not seeded)')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two JSON reports instead of running')
+    parser.add_argument('--threshold', type=float, default=15,
+                        help='percent of p95 or req/sec change that is a regression')
+    parser.add_argument('--min-requests', type=int, default=200,
+                        help='ignore the operations measured fewer times than this')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as base, open(args.compare[1]) as new:
+            regressions = compare(json.load(base), json.load(new), args.threshold,
+                                  args.min_requests)
+        if regressions:
+            print('regressions: {}'.format(', '.join(regressions)))
+        return 1 if regressions else 0
+
+    process, url = None, args.url
+    if not url:
+        seed(args.rows, args.customers, args.products, args.seed)
+        process, url = start(args.workers, args.threads)
+    try:
+        if args.warmup:
+            measure(url, argparse.Namespace(**dict(vars(args), seconds=args.warmup)))
+        report = measure(url, args)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    report['run'] = {
+        'commit': git_commit(),
+        'date': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': url if args.url else DATABASE_URI.split(':', 1)[0],
+        'rows': args.rows, 'customers': args.customers, 'products': args.products,
+        'concurrency': args.concurrency, 'seconds': args.seconds, 'seed': args.seed,
+        'workers': args.workers, 'threads': args.threads,
+    }
+    print_table(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
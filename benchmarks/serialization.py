@@ -0,0 +1,87 @@
+"""
+Serialization Microbenchmarks
+
+Times each step between the database and a JSON body, one at a time, so
+that a change to one of them can be measured on its own:
+  hydrate     - load Order instances with the ORM
+  serialize   - Order.serialize of loaded Orders
+  deserialize - Order().deserialize of dictionaries
+  marshal     - flask_restplus marshal with the Order model
+  jsonify     - Flask jsonify of serialized Orders
+  dumps       - encoding.dumps of serialized Orders
+and, once per run, the whole create response of POST /orders.
+
+For every number of rows it reports the time per call and per row:
+  python -m benchmarks.serialization --sizes 1 100 10000 100000
+"""
+import os
+import sys
+import timeit
+import argparse
+import tempfile
+
+DEFAULT_URI = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'orders-bench.db')
+os.environ.setdefault('DATABASE_URI', DEFAULT_URI)
+
+from flask import jsonify                  # pylint: disable=wrong-import-position
+from flask_restplus import marshal         # pylint: disable=wrong-import-position
+from service import app, encoding          # pylint: disable=wrong-import-position
+from service.models import Order, db       # pylint: disable=wrong-import-position
+from service.service import order_model    # pylint: disable=wrong-import-position
+from benchmarks.list_serialization import seed  # pylint: disable=wrong-import-position
+
+def steps(size):
+    """ Returns the steps to time for size rows, and what they need prepared """
+    orders = Order.query.order_by(Order.id).limit(size).all()
+    data = [order.serialize() for order in orders]
+    return {
+        'hydrate': lambda: (Order.query.order_by(Order.id).limit(size).all(),
+                            db.session.expunge_all()),
+        'serialize': lambda: [order.serialize() for order in orders],
+        'deserialize': lambda: [Order().deserialize(item) for item in data],
+        'marshal': lambda: marshal(data, order_model),
+        'jsonify': lambda: jsonify(data).get_data(),
+        'dumps': lambda: encoding.dumps(data),
+    }
+
+def create_response(client, count=[0]):    # pylint: disable=dangerous-default-value
+    """ Posts a new Order and reads the response """
+    count[0] += 1
+    resp = client.post('/orders', json={'uuid': 'bench-{}'.format(count[0]), 'customer_id': 1,
+                                        'product_id': 1, 'price': 1, 'quantity': 1,
+                                        'status': 'In Progress'})
+    return resp.get_data()
+
+def time_call(function, repeat):
+    """ Returns the best time (seconds) of one call of a function """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+def main(argv=None):
+    """ Runs the benchmarks and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel('WARNING')
+    Order.logger.setLevel('WARNING')
+    Order.init_db(app)
+    seed(max(args.sizes))
+    print('JSON encoder: {}'.format(encoding.ENCODER))
+    print('{:>8}{:>13}{:>14}{:>12}'.format('rows', 'step', 'ms/call', 'us/row'))
+    with app.test_request_context():
+        for size in args.sizes:
+            for name, step in steps(size).items():
+                seconds = time_call(step, args.repeat)
+                print('{:>8}{:>13}{:>14,.3f}{:>12,.2f}'.format(size, name, 1000 * seconds,
+                                                            1e6 * seconds / size))
+            db.session.remove()
+    seconds = time_call(lambda: create_response(app.test_client()), args.repeat)
+    print('{:>8}{:>13}{:>14,.3f}'.format(1, 'POST /orders', 1000 * seconds))
+    db.drop_all()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+Order Service with a Slow Database
+
+Adds DB_LATENCY_MS milliseconds to every round trip to the database, so
+that a local SQLite file stands in for a database across a network. The
+sync service sleeps in its thread, the async service awaits:
+  gunicorn benchmarks.slow_database:wsgi_app
+  uvicorn benchmarks.slow_database:asgi_app
+"""
+import os
+import time
+import asyncio
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from databases.backends.sqlite import SQLiteConnection
+from service import app as wsgi_app        # pylint: disable=unused-import
+from service.asgi import app as asgi_app   # pylint: disable=unused-import
+
+LATENCY = float(os.environ.get('DB_LATENCY_MS', 0)) / 1000
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sleep(*args):
+    """ Waits before every statement of the sync service """
+    time.sleep(LATENCY)
+
+def slowed(method):
+    """ Wraps a method of the async connection to wait before it runs """
+    async def wrapper(*args, **kwargs):
+        await asyncio.sleep(LATENCY)
+        return await method(*args, **kwargs)
+    return wrapper
+
+for name in ('fetch_all', 'fetch_one', 'execute', 'execute_many'):
+    setattr(SQLiteConnection, name, slowed(getattr(SQLiteConnection, name)))
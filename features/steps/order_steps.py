@@ -23,19 +23,20 @@ def step_impl(context):
     headers = {'Content-Type': 'application/json'}
     context.resp = requests.delete(context.base_url + '/orders/reset', headers=headers)
     expect(context.resp.status_code).to_equal(204)
-    create_url = context.base_url + '/orders'
+    create_url = context.base_url + '/orders/bulk'
+    data = []
     for row in context.table:
-        data = {
+        data.append({
             "uuid": row['uuid'],
-            "price": row['price'],
-            "quantity": row['quantity'],
-            "customer_id": row['customer_id'],
-            "product_id": row['product_id'],
+            "price": int(row['price']),
+            "quantity": int(row['quantity']),
+            "customer_id": int(row['customer_id']),
+            "product_id": int(row['product_id']),
             "status": row['Status']
-            }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+            })
+    payload = json.dumps(data)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(201)
 
 
 @when(u'I visit the "home page"')
@@ -0,0 +1,169 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Gunicorn Configuration
+
+  gunicorn --config=gunicorn_config.py service:app
+
+The number of workers follows the CPUs the container may use (its cgroup
+quota, not the cores of the host) and is capped by its memory limit; each
+worker runs WORKER_THREADS threads, so requests that wait on the database
+do not hold a whole process. The application is imported once in the
+master (preload) and shared copy-on-write, and every worker is recycled
+after about GUNICORN_MAX_REQUESTS requests to bound slow memory growth.
+
+Environment
+-----------
+PORT - the port to listen on (default 8080)
+WEB_CONCURRENCY - the number of workers (default 2 per CPU + 1, memory permitting)
+WORKER_THREADS - the threads per worker (default 4, 1 for the sync worker class)
+MAX_EVENT_STREAMS - the event streams per worker (default 16), each with a gthread
+    thread of its own on top of the WORKER_THREADS; 0 for the sync worker class,
+    which answers 503 to the streams and does not hold the long polls
+WORKER_CLASS - gthread (default) or sync
+WORKER_MEMORY_MB - the memory a worker needs, to cap the workers (default 64)
+MEMORY_LIMIT - the memory limit when there is no cgroup one, e.g. 512M (Cloud Foundry)
+GUNICORN_MAX_REQUESTS - recycle a worker after this many requests (default 1000, 0 never)
+GUNICORN_TIMEOUT - restart a worker that is silent this many seconds (default 30)
+GUNICORN_PRELOAD - import the application in the master (default true)
+prometheus_multiproc_dir - where the workers share their metrics (default a new
+    temporary directory), emptied when gunicorn starts
+
+WEB_CONCURRENCY, WORKER_THREADS and MAX_EVENT_STREAMS are exported, so the
+connection pools of the workers are sized to match (see service/pool.py)
+and the event streams never take the threads of the requests.
+"""
+import os
+import re
+import glob
+import tempfile
+import multiprocessing
+
+CGROUP = '/sys/fs/cgroup'
+
+def read(path):
+    """ Returns the stripped content of a file, or None if it cannot be read """
+    try:
+        with open(path) as handle:
+            return handle.read().strip()
+    except (IOError, OSError):
+        return None
+
+def cpu_limit():
+    """ Returns the number of CPUs this process may use, rounded up """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else multiprocessing.cpu_count()
+    quota = read(os.path.join(CGROUP, 'cpu.max'))                           # cgroup v2
+    if quota:
+        limit, period = (quota.split() + ['100000'])[:2]
+    else:                                                                   # cgroup v1
+        limit = read(os.path.join(CGROUP, 'cpu', 'cpu.cfs_quota_us'))
+        period = read(os.path.join(CGROUP, 'cpu', 'cpu.cfs_period_us'))
+    if limit and period and limit not in ('max', '-1'):
+        cpus = min(cpus, max(1, -(-int(limit) // int(period))))
+    return cpus
+
+def memory_limit():
+    """ Returns the memory limit of this process in bytes, or None """
+    for path in (os.path.join(CGROUP, 'memory.max'),                       # cgroup v2
+                 os.path.join(CGROUP, 'memory', 'memory.limit_in_bytes')):  # cgroup v1
+        value = read(path)
+        # cgroup v1 reports a huge number when there is no limit
+        if value and value.isdigit() and int(value) < 2 ** 60:
+            return int(value)
+    match = re.match(r'^(\d+)\s*([KMG]?)', os.environ.get('MEMORY_LIMIT', '').upper())
+    if match:
+        return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+    return None
+
+def default_workers():
+    """ Returns 2 workers per CPU + 1, or as many as fit in the memory limit """
+    workers = 2 * cpu_limit() + 1
+    memory = memory_limit()
+    if memory:
+        worker_memory = int(os.environ.get('WORKER_MEMORY_MB', 64)) * 1024 ** 2
+        workers = min(workers, max(1, memory // worker_memory))
+    return workers
+
+def worker_threads(worker_class):
+    """
+    Returns the threads of a worker for its requests, the event streams it
+    serves, and its threads in all
+    """
+    if worker_class == 'sync':
+        # a sync worker has a single thread, that an event stream would hold
+        # for minutes while the requests queue up behind it
+        streams = int(os.environ.get('MAX_EVENT_STREAMS', 0))
+        if streams:
+            raise ValueError('MAX_EVENT_STREAMS must be 0 for the sync worker class, '
+                             'not {}'.format(streams))
+        return int(os.environ.get('WORKER_THREADS') or 1), 0, 1
+    requests = int(os.environ.get('WORKER_THREADS') or 4)
+    streams = int(os.environ.get('MAX_EVENT_STREAMS', 16))
+    return requests, streams, requests + streams
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8080))
+worker_class = os.environ.get('WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY') or default_workers())
+request_threads, event_streams, threads = worker_threads(worker_class)
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['WORKER_THREADS'] = str(request_threads)
+os.environ['MAX_EVENT_STREAMS'] = str(event_streams)
+
+# the workers add up their metrics through files (see service/metrics.py),
+# which also keeps the counters of the workers that were recycled
+if 'prometheus_multiproc_dir' not in os.environ:
+    os.environ['prometheus_multiproc_dir'] = tempfile.mkdtemp(prefix='orders-metrics-')
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+# spread the restarts so that the workers are not all recycled at once
+max_requests_jitter = max_requests // 10
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = timeout
+keepalive = 5
+errorlog = '-'
+# the heartbeat files of the workers are kept in memory, not on a slow disk
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+def dispose_engine():
+    """ Closes the pooled database connections of this process, if any """
+    from service import app                     # pylint: disable=import-outside-toplevel
+    from service.models import db               # pylint: disable=import-outside-toplevel
+    db.get_engine(app).dispose()
+
+def on_starting(server):
+    """ Removes the metrics of a previous run of the service """
+    for path in glob.glob(os.path.join(os.environ['prometheus_multiproc_dir'], '*.db')):
+        os.remove(path)
+
+def pre_fork(server, worker):
+    """ Closes the connections of the master before it forks a worker """
+    # a connection opened while preloading must not be inherited, or two
+    # processes would talk over the same socket
+    if preload_app:
+        dispose_engine()
+
+def post_fork(server, worker):
+    """ Starts each worker with a pool of its own """
+    if preload_app:
+        dispose_engine()
+    server.log.info('Worker %s started with %s threads', worker.pid, threads)
+
+def child_exit(server, worker):
+    """ Drops the in-flight requests of a worker that exited """
+    from service.metrics import mark_process_dead  # pylint: disable=import-outside-toplevel
+    mark_process_dead(worker.pid)
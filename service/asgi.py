@@ -0,0 +1,784 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous Order Service
+
+The routes of service/service.py as an ASGI application, served with:
+  uvicorn --workers=1 --port=$PORT service.asgi:app
+
+The views are coroutines and the database is reached through the
+databases package (aiosqlite, asyncpg or aiomysql), so while one request
+waits on a query the process keeps serving the others instead of holding
+a worker thread per request. The SQL is the Core of the Order model and
+the responses match the Flask service: the same JSON, ETags, cursors,
+Link headers and Order cache. The Swagger docs and the static pages are
+only served by the Flask service, and the schema is created and upgraded
+with: FLASK_APP=service:app flask db-upgrade
+
+The async driver is chosen from the scheme of DATABASE_URI, e.g.
+mysql+pymysql:// becomes mysql:// (aiomysql); set ASYNC_DATABASE_URI to
+override it.
+"""
+import os
+import re
+import time
+import asyncio
+import sqlite3
+from http import HTTPStatus
+import databases
+from starlette.applications import Starlette
+from starlette.endpoints import HTTPEndpoint
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException, NotFound, BadRequest, Conflict, \
+    PreconditionFailed
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from flask_api import status    # HTTP Status Codes
+
+from service import app as flask_app
+from service.models import Order, DataValidationError, TransitionError, VersionConflictError, \
+    db, MAX_PAGE_SIZE, PAGE_SIZE, STREAM_BATCH_SIZE, BULK_BATCH_SIZE, MAX_BULK_SIZE, \
+    STATUSES, SORT_KEYS, MAX_CHANGES_WAIT, CHANGES_POLL_INTERVAL, MAX_INTEGER
+from service.service import BULK_ACTIONS, NDJSON, bulk_selection, collection_etag, \
+    encode_cursor, decode_cursor
+from service.encoding import dumps, encode_rows, encode_ndjson
+from service import events, metrics, pool
+
+logger = flask_app.logger
+
+# the database of the Flask app, connected when the application starts
+database = None
+
+KEYS = Order.column_names()
+# the function that returns the rows changed by the last statement of a connection
+ROW_COUNT = {'sqlite': 'changes()', 'mysql': 'ROW_COUNT()'}
+SORT_CHOICES = SORT_KEYS + tuple('-' + key for key in SORT_KEYS)
+FILTERS = ('customer_id', 'product_id', 'min_price', 'max_price', 'min_quantity',
+           'max_quantity')
+
+######################################################################
+#  PATH: /orders/{id}
+######################################################################
+class OrderResource(HTTPEndpoint):
+    """
+    Allows the manipulation of a single Order
+    GET /orders/{id} - Returns an Order with the id
+    PUT /orders/{id} - Update an Order with the id
+    DELETE /orders/{id} -  Deletes an Order with the id
+    """
+
+    async def get(self, request):
+        """ Retrieve a single Order, reading through the cache """
+        order_id = request.path_params['order_id']
+        logger.info('Request for an order with id: %s', order_id)
+        order = Order.cache.get(order_id)
+        if order is None:
+            generation = Order.cache.generation()
+            row = await database.fetch_one(Order.__table__.select().where(Order.id == order_id))
+            if row is None:
+                raise NotFound("Order with id '{}' was not found.".format(order_id))
+            order = dict(row)
+            Order.cache.set(order_id, order, generation)
+        etag = str(order['version'])
+        if if_none_match(request, etag):
+            return not_modified(etag)
+        return json_response(order, etag=etag)
+
+    async def put(self, request):
+        """
+        Update an Order
+        When the body has a version (or the request an If-Match header) the
+        Order is only updated if it is still at that version
+        """
+        order_id = request.path_params['order_id']
+        logger.info('Request to update order with id: %s', order_id)
+        data = await json_body(request)
+        versions = if_match_versions(request)
+        try:
+            expected = versions
+            if expected is None and Order.version_of(data) is not None:
+                expected = [Order.version_of(data)]
+            order = await replace(order_id, data, expected)
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        except VersionConflictError as error:
+            if versions is not None:
+                raise PreconditionFailed(str(error))
+            raise Conflict(str(error))
+        if not order:
+            raise NotFound("Order with id '{}' was not found.".format(order_id))
+        return json_response(order, etag=str(order['version']))
+
+    async def delete(self, request):
+        """ Delete an Order """
+        order_id = request.path_params['order_id']
+        logger.info('Request to delete an order with id: %s', order_id)
+        async with database.transaction():
+            for statement in Order.delete_statements(Order.id == order_id):
+                await database.execute(statement)
+        Order.cache.delete(order_id)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+######################################################################
+#  PATH: /orders
+######################################################################
+class OrderCollection(HTTPEndpoint):
+    """ Handles all interactions with collections of Orders """
+
+    async def get(self, request):
+        """ Returns a page of the Orders that match the query string """
+        logger.info('Request for order list')
+        args = {name: int_arg(request, name) for name in FILTERS}
+        args['status'] = choice_arg(request, 'status', STATUSES)
+        return await paginated_response(request, Order.search_criteria(**args))
+
+    async def post(self, request):
+        """
+        Creates an Order
+        Posting an Order with the uuid of an existing one returns the existing Order
+        """
+        logger.info('Request to create an order')
+        try:
+            order, created = await create_or_get(await json_body(request))
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        location_url = request.url_for('OrderResource', order_id=order['id'])
+        code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        return json_response(order, code, headers={'Location': location_url})
+
+######################################################################
+#  PATH: /orders/bulk
+######################################################################
+class OrderBulkResource(HTTPEndpoint):
+    """ Creates many Orders with one request and one transaction """
+
+    async def post(self, request):
+        """ Creates many Orders and returns a result for each one """
+        logger.info('Request to bulk create orders')
+        items = await json_body(request)
+        if not isinstance(items, list):
+            raise BadRequest('The body must be a list of orders')
+        if len(items) > MAX_BULK_SIZE:
+            raise BadRequest('At most {} orders can be created at once'.format(MAX_BULK_SIZE))
+        results = []
+        for result in await bulk_create(items):
+            if isinstance(result, DataValidationError):
+                results.append({'code': status.HTTP_400_BAD_REQUEST, 'message': str(result)})
+            else:
+                order, created = result
+                code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+                results.append({'code': code, 'order': order.serialize()})
+        created = sum(1 for result in results if result['code'] == status.HTTP_201_CREATED)
+        existing = sum(1 for result in results if result['code'] == status.HTTP_200_OK)
+        failed = len(results) - created - existing
+        code = status.HTTP_201_CREATED if created == len(results) else status.HTTP_207_MULTI_STATUS
+        return json_response({'created': created,
+                              'existing': existing,
+                              'failed': failed,
+                              'results': results}, code)
+
+######################################################################
+#  PATH: /orders/bulk/{action}
+######################################################################
+class OrderBulkTransitionResource(HTTPEndpoint):
+    """ Changes the status of many Orders with one UPDATE """
+
+    async def put(self, request):
+        """ Cancel or deliver many Orders """
+        action = request.path_params['action']
+        logger.info('Request to bulk %s orders', action)
+        if action not in BULK_ACTIONS:
+            raise NotFound("Bulk action '{}' was not found.".format(action))
+        new_status = BULK_ACTIONS[action]
+        selection = bulk_selection(new_status, await json_body(request))
+        try:
+            condition = Order.bulk_condition(new_status, **selection)
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        async with database.transaction():
+            rows = await database.fetch_all(Order.lock_statement(condition))
+            changed = [row['id'] for row in rows]
+            for statement in Order.bulk_transition_statements(changed, new_status):
+                await database.execute(statement)
+        for order_id in changed:
+            Order.cache.delete(order_id)
+        return json_response({'count': len(changed), 'ids': changed})
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+class OrderChangesResource(HTTPEndpoint):
+    """ The change log of the Orders, for the services that follow them """
+
+    async def get(self, request):
+        """ Returns the changes after a sequence number, waiting for one with wait """
+        since = int_arg(request, 'since', 0, 0, MAX_INTEGER)
+        limit = int_arg(request, 'limit', PAGE_SIZE, 1, MAX_PAGE_SIZE)
+        deadline = time.monotonic() + int_arg(request, 'wait', 0, 0, MAX_CHANGES_WAIT)
+        while True:
+            rows = await database.fetch_all(Order.changes_statement(since, limit))
+            rows, last = Order.changes_of(rows, since)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                break
+            await asyncio.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+        return json_response({'changes': [Order.serialize_change(row) for row in rows],
+                              'next': last})
+
+######################################################################
+#  PATH: /orders/events
+######################################################################
+class OrderEventsResource(HTTPEndpoint):
+    """ Pushes the changes of the Orders to browsers as they happen """
+
+    async def get(self, request):
+        """ Streams the changes to the Orders as Server-Sent Events """
+        criteria = {name: int_arg(request, name) for name in events.FILTERS}
+        subscription = events.AsyncSubscription(asyncio.get_event_loop(), **criteria)
+        # waits for the publisher thread to start, off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, events.publisher.subscribe,
+                                                       subscription)
+        since = events.last_event_id(request.headers.get('last-event-id'))
+        return StreamingResponse(event_stream(subscription, since),
+                                 media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache',
+                                          'X-Accel-Buffering': 'no'})
+
+######################################################################
+# CANCEL AN ORDER
+######################################################################
+class OrderCancelResource(HTTPEndpoint):
+    """ Cancels an Order that is In Progress """
+
+    async def put(self, request):
+        """ Cancel an Order, no body is needed """
+        order_id = request.path_params['order_id']
+        logger.info('Request to cancel an order with id: %s', order_id)
+        try:
+            order = await transition(order_id, 'Cancelled', if_match_versions(request))
+        except VersionConflictError as error:
+            raise PreconditionFailed(str(error))
+        except TransitionError as error:
+            raise Conflict(str(error))
+        if not order:
+            raise NotFound("Order with id '{}' was not found.".format(order_id))
+        return json_response(order, etag=str(order['version']))
+
+######################################################################
+# LIST AND SUMMARIZE ORDERS BASED ON PRODUCT OR CUSTOMER ID
+######################################################################
+class OrderProductListResource(HTTPEndpoint):
+    """ Lists the Orders of a product """
+
+    async def get(self, request):
+        """ Returns a page of the Orders for a product """
+        logger.info('Request for order list')
+        product_id = request.path_params['product_id']
+        return await paginated_response(request, [Order.product_id == product_id])
+
+class OrderCustomerListResource(HTTPEndpoint):
+    """ Lists the Orders of a customer """
+
+    async def get(self, request):
+        """ Returns a page of the Orders for a customer """
+        customer_id = request.path_params['customer_id']
+        logger.info('Request for order list based on customer id: %s', customer_id)
+        return await paginated_response(request, [Order.customer_id == customer_id])
+
+class OrderCustomerSummaryResource(HTTPEndpoint):
+    """ Returns the order totals of a customer """
+
+    async def get(self, request):
+        """ Summarize the Orders of a customer """
+        customer_id = request.path_params['customer_id']
+        logger.info('Request for order summary of customer: %s', customer_id)
+        summary = await summarize(Order.customer_id == customer_id)
+        summary['customer_id'] = customer_id
+        return json_response(summary)
+
+class OrderProductSummaryResource(HTTPEndpoint):
+    """ Returns the order totals of a product """
+
+    async def get(self, request):
+        """ Summarize the Orders of a product """
+        product_id = request.path_params['product_id']
+        logger.info('Request for order summary of product: %s', product_id)
+        summary = await summarize(Order.product_id == product_id)
+        summary['product_id'] = product_id
+        return json_response(summary)
+
+######################################################################
+# DELETE ALL ORDERS (for testing only), CACHE AND POOL STATISTICS
+######################################################################
+async def orders_reset(request):
+    """ Removes all orders from the database """
+    async with database.transaction():
+        for statement in Order.delete_statements(db.true()):
+            await database.execute(statement)
+    Order.cache.clear()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+async def cache_stats(request):
+    """ Returns the counters of the order cache for tuning """
+    return json_response(Order.cache.stats())
+
+async def connection_pool_stats(request):
+    """ Returns the state of the connection pool of the driver for tuning """
+    # the databases package does not expose the pool of its backend
+    backend_pool = database._backend._pool     # pylint: disable=protected-access
+    return json_response(pool.async_pool_stats(backend_pool))
+
+######################################################################
+# HEALTH CHECKS
+######################################################################
+async def liveness(request):
+    """ Returns 200 while the process can answer requests """
+    return json_response({'status': 'OK'})
+
+async def readiness(request):
+    """ Returns 200 when the database can be reached and 503 when it cannot """
+    try:
+        await database.fetch_val(db.select([db.literal_column('1')]))
+    except Exception as error:   # pylint: disable=broad-except
+        # each driver raises its own errors, and none of them means ready
+        logger.warning('Database is not reachable: %s', error)
+        return json_response({'status': 'Service Unavailable', 'database': str(error)},
+                             status.HTTP_503_SERVICE_UNAVAILABLE)
+    return json_response({'status': 'OK', 'database': 'OK'})
+
+######################################################################
+#  D A T A B A S E   A C C E S S
+######################################################################
+
+def integrity_errors():
+    """ Returns the IntegrityError classes of the async drivers that are installed """
+    # each driver raises its own errors, not the ones of SQLAlchemy
+    errors = [sqlite3.IntegrityError]
+    try:
+        import pymysql                          # pylint: disable=import-outside-toplevel
+        errors.append(pymysql.err.IntegrityError)
+    except ImportError:
+        pass
+    try:
+        import asyncpg                          # pylint: disable=import-outside-toplevel
+        errors.append(asyncpg.exceptions.IntegrityConstraintViolationError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+INTEGRITY_ERRORS = integrity_errors()
+
+async def create_or_get(data):
+    """ Creates an Order unless its uuid exists, see Order.create_or_get
+
+    Returns:
+        a tuple of the serialized Order and whether it was created
+    """
+    values = dict(Order().deserialize(data).columns(), version=1)
+    insert = Order.__table__.insert().values(**values)
+    if database.url.dialect == 'postgresql':
+        insert = insert.returning(Order.id)
+    try:
+        async with database.transaction():
+            order_id = await database.execute(insert)
+            for statement in Order.log_statements('create', [Order.id == order_id]):
+                await database.execute(statement)
+    except INTEGRITY_ERRORS as error:
+        if not Order.is_duplicate_uuid(error):
+            raise
+        existing = await database.fetch_one(Order.__table__.select()
+                                            .where(Order.uuid == values['uuid']))
+        if existing is None:
+            raise
+        logger.info('Order %s already exists', values['uuid'])
+        return dict(existing), False
+    return dict(values, id=order_id), True
+
+async def bulk_create(items):
+    """ Creates many Orders in a single transaction, see Order.bulk_create
+
+    Returns:
+        a list with, for each item, either a tuple of the Order and whether
+        it was created, or the DataValidationError of the item
+    """
+    orders = []
+    for item in items:
+        try:
+            orders.append(Order().deserialize(item))
+        except DataValidationError as error:
+            orders.append(error)
+    try:
+        return await bulk_insert(orders)
+    except INTEGRITY_ERRORS as error:
+        if not Order.is_duplicate_uuid(error):
+            raise
+        # another request created one of the uuids in the meantime,
+        # which the lookup of the existing Orders finds the second time
+        return await bulk_insert(orders)
+
+async def bulk_insert(orders):
+    """ Inserts the Orders whose uuid does not exist yet, see Order.insert_new """
+    async with database.transaction():
+        existing = []
+        for query in Order.existing_statements(orders):
+            existing.extend(Order(**dict(row)) for row in await database.fetch_all(query))
+        results, created = Order.plan_insert(orders, existing)
+        logged = []
+        for start in range(0, len(created), BULK_BATCH_SIZE):
+            batch = created[start:start + BULK_BATCH_SIZE]
+            # databases leaves out the column defaults of SQLAlchemy
+            await database.execute_many(Order.__table__.insert(),
+                                        [dict(order.columns(), version=1) for order in batch])
+            rows = await database.fetch_all(Order.ids_statement(batch))
+            logged.append(Order.inserted(batch, [tuple(row.values()) for row in rows]))
+        if logged:
+            for statement in Order.log_statements('create', logged):
+                await database.execute(statement)
+    return results
+
+async def replace(order_id, data, versions=None):
+    """ Replaces the data of an Order, see Order.replace """
+    values = Order().deserialize(data).columns()
+    return await update_where(order_id, versions, None, **values)
+
+async def transition(order_id, new_status, versions=None):
+    """ Moves one Order to a new status, see Order.transition """
+    return await update_where(order_id, versions, new_status, status=new_status)
+
+async def update_where(order_id, versions, new_status, **values):
+    """
+    Updates an Order with one conditional UPDATE, like Order._update_where
+
+    databases does not return the rowcount of an UPDATE, so PostgreSQL
+    returns the new row itself and the other databases are asked how many
+    rows the UPDATE changed on the same connection.
+
+    Returns:
+        the serialized Order that was updated, or None when there is no
+        Order with the id
+    """
+    table = Order.__table__
+    update = Order.update_statement(order_id, Order.update_condition(versions, new_status),
+                                    **values)
+    dialect = database.url.dialect
+    async with database.transaction():
+        if dialect == 'postgresql':
+            row = await database.fetch_one(update.returning(*table.columns))
+        else:
+            await database.execute(update)
+            changed = await database.fetch_val(db.select([db.literal_column(ROW_COUNT[dialect])]))
+            row = await database.fetch_one(table.select().where(Order.id == order_id)) \
+                if changed else None
+        if row is None:
+            current = await database.fetch_one(db.select([Order.status, Order.version])
+                                               .where(Order.id == order_id))
+        else:
+            for statement in Order.log_statements('update', [Order.id == order_id]):
+                await database.execute(statement)
+    if row is None:
+        if current is None:
+            return None
+        Order.refuse_update(order_id, current, versions, new_status)
+    Order.cache.delete(order_id)
+    return dict(row)
+
+async def summarize(whereclause):
+    """ Aggregates the Orders that match a clause, see Order.summarize """
+    rows = await database.fetch_all(Order.summary_statement(whereclause))
+    return Order.summary_of(tuple(row.values()) for row in rows)
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+async def paginated_response(request, criteria):
+    """ Returns one page of the Orders that match the criteria as a JSON list
+
+    Same paging, ETag and streaming as paginated_response in service.py
+    """
+    limit = int_arg(request, 'limit', PAGE_SIZE, 1, MAX_PAGE_SIZE)
+    sort_arg = choice_arg(request, 'sort', SORT_CHOICES, 'id')
+    sort = sort_arg.lstrip('-')
+    descending = sort_arg.startswith('-')
+    after = decode_cursor(request.query_params.get('cursor'), sort)
+    whereclause = db.and_(*criteria) if criteria else None
+    accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+    if bool_arg(request, 'stream') or accept.best_match(['application/json', NDJSON]) == NDJSON:
+        return StreamingResponse(stream_rows(whereclause, after, sort, descending),
+                                 media_type=NDJSON)
+    rows = await database.fetch_all(Order.page_statement(whereclause, after, limit, sort,
+                                                         descending))
+    rows, after = Order.page_of(rows, limit, sort)
+    etag = collection_etag((row['id'], row['version']) for row in rows)
+    if if_none_match(request, etag):
+        response = not_modified(etag)
+    else:
+        response = Response(encode_rows(KEYS, [row.values() for row in rows]),
+                            media_type='application/json',
+                            headers={'ETag': quote_etag(etag)})
+    if after is not None:
+        cursor = encode_cursor(after)
+        next_url = request.url.include_query_params(cursor=cursor, limit=limit)
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        response.headers['X-Next-Cursor'] = cursor
+    return response
+
+async def stream_rows(whereclause, after, sort, descending):
+    """ Yields every matching Order as NDJSON, one batch of rows at a time """
+    while True:
+        rows = await database.fetch_all(Order.page_statement(whereclause, after,
+                                                             STREAM_BATCH_SIZE, sort,
+                                                             descending))
+        rows, after = Order.page_of(rows, STREAM_BATCH_SIZE, sort)
+        if rows:
+            yield encode_ndjson(KEYS, [row.values() for row in rows])
+        if after is None:
+            return
+
+async def event_stream(subscription, since):
+    """ Yields the body of an event stream, see events.stream """
+    try:
+        yield b'retry: %d\n\n' % events.EVENT_RETRY_MS
+        if since is not None:
+            while True:
+                rows = await database.fetch_all(Order.changes_statement(since,
+                                                                        MAX_PAGE_SIZE))
+                rows, since = Order.changes_of(rows, since)
+                for _, event in events.missed_events(subscription, rows):
+                    yield event
+                if len(rows) < MAX_PAGE_SIZE:
+                    break
+        deadline = time.monotonic() + events.EVENT_STREAM_SECONDS
+        while not subscription.overflowed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                seq, event = await asyncio.wait_for(
+                    subscription.queue.get(), min(events.EVENT_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                yield b': keep-alive\n\n'
+                continue
+            if since is None or seq > since:
+                yield event
+    finally:
+        events.publisher.unsubscribe(subscription)
+
+def json_response(data, code=status.HTTP_200_OK, etag=None, headers=None):
+    """ Returns a JSON response, with an ETag when one is given """
+    headers = dict(headers or {})
+    if etag is not None:
+        headers['ETag'] = quote_etag(etag)
+    return Response(dumps(data), status_code=code, headers=headers,
+                    media_type='application/json')
+
+def not_modified(etag):
+    """ Returns a 304 Not Modified response for an ETag """
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers={'ETag': quote_etag(etag)})
+
+def if_none_match(request, etag):
+    """ Returns True when If-None-Match lists the ETag """
+    return parse_etags(request.headers.get('if-none-match')).contains_weak(etag)
+
+def if_match_versions(request):
+    """ Returns the Order versions listed in If-Match, or None for any version
+
+    Raises BadRequest when a tag is not a version
+    """
+    if_match = parse_etags(request.headers.get('if-match'))
+    if not if_match or if_match.star_tag:
+        return None
+    tags = if_match.as_set()
+    if not all(tag.isdigit() for tag in tags):
+        raise BadRequest('If-Match must list Order versions, not {}'.format(
+            request.headers.get('if-match')))
+    return [int(tag) for tag in tags]
+
+async def json_body(request):
+    """ Returns the JSON body of a request or raises BadRequest """
+    try:
+        return await request.json()
+    except ValueError:
+        raise BadRequest('The body must be valid JSON')
+
+def int_arg(request, name, default=None, low=None, high=None):
+    """ Returns an integer query string argument or raises BadRequest """
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest("{} must be an integer, not '{}'".format(name, value))
+    if (low is not None and number < low) or (high is not None and number > high):
+        raise BadRequest('{} must be between {} and {}'.format(name, low, high))
+    return number
+
+def choice_arg(request, name, choices, default=None):
+    """ Returns a query string argument that must be one of the choices """
+    value = request.query_params.get(name, default)
+    if value is not None and value not in choices:
+        raise BadRequest("{} must be one of {}, not '{}'".format(name, ', '.join(choices),
+                                                                 value))
+    return value
+
+def bool_arg(request, name):
+    """ Returns a boolean query string argument, False when it is missing """
+    value = request.query_params.get(name, 'false').lower()
+    if value not in ('true', '1', 'false', '0'):
+        raise BadRequest("{} must be a boolean, not '{}'".format(name, value))
+    return value in ('true', '1')
+
+def async_database_uri(uri):
+    """ Returns the databases URL of a SQLAlchemy URI, without the sync driver """
+    return re.sub(r'^(\w+)\+\w+://', r'\1://', uri)
+
+async def connect():
+    """ Connects to the database of the Flask app """
+    global database
+    uri = os.getenv('ASYNC_DATABASE_URI') or \
+        async_database_uri(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    database = TimedDatabase(uri)
+    await database.connect()
+
+async def disconnect():
+    """ Closes the connections to the database """
+    await database.disconnect()
+
+async def http_error(request, error):
+    """ Returns the JSON body of the Flask error handlers for an HTTP error """
+    if isinstance(error, HTTPException):
+        code, message = error.code, error.description
+    else:
+        code, message = error.status_code, error.detail
+    if code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+        logger.error(message)
+    else:
+        logger.warning(message)
+    return json_response({'status': code,
+                          'error': HTTPStatus(code).phrase,
+                          'message': message}, code)
+
+async def internal_server_error(request, error):
+    """ Handles unexpected server error with 500_SERVER_ERROR """
+    logger.error(str(error))
+    return json_response({'status': status.HTTP_500_INTERNAL_SERVER_ERROR,
+                          'error': 'Internal Server Error',
+                          'message': str(error)}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+######################################################################
+#  M E T R I C S
+######################################################################
+
+class TimedDatabase(databases.Database):
+    """ A database whose statements are timed and counted for their request """
+
+    async def fetch_all(self, query, values=None):
+        with metrics.timed_query():
+            return await super(TimedDatabase, self).fetch_all(query, values)
+
+    async def fetch_one(self, query, values=None):
+        with metrics.timed_query():
+            return await super(TimedDatabase, self).fetch_one(query, values)
+
+    async def fetch_val(self, query, values=None, column=0):
+        with metrics.timed_query():
+            return await super(TimedDatabase, self).fetch_val(query, values, column)
+
+    async def execute(self, query, values=None):
+        with metrics.timed_query():
+            return await super(TimedDatabase, self).execute(query, values)
+
+    async def execute_many(self, query, values):
+        with metrics.timed_query():
+            return await super(TimedDatabase, self).execute_many(query, values)
+
+class MetricsMiddleware(object):
+    """ Records the metrics of every HTTP request, as metrics.init_app does for Flask
+
+    The endpoint label is the name of the HTTPEndpoint class or function of
+    the route. The latency, size and statements of a response are recorded
+    when it starts, so those of a stream stop at its first byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        queries = [0, 0.0]
+        token = metrics.ASYNC_QUERIES.set(queries)
+
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                method = scope['method']
+                endpoint = getattr(scope.get('endpoint'), '__name__', 'unmatched')
+                metrics.REQUESTS.labels(method, endpoint, message['status']).inc()
+                metrics.LATENCY.labels(method, endpoint).observe(time.perf_counter() - start)
+                headers = dict(message.get('headers') or [])
+                if b'content-length' in headers:
+                    metrics.RESPONSE_SIZE.labels(method, endpoint).observe(
+                        int(headers[b'content-length']))
+                metrics.QUERIES.labels(method, endpoint).observe(queries[0])
+                metrics.QUERY_TIME.labels(method, endpoint).observe(queries[1])
+            await send(message)
+
+        metrics.IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            metrics.IN_FLIGHT.dec()
+            metrics.ASYNC_QUERIES.reset(token)
+
+async def prometheus_metrics(request):
+    """ Returns the metrics of the service in the Prometheus text format """
+    data, content_type = metrics.expose()
+    return Response(data, headers={'Content-Type': content_type})
+
+######################################################################
+#  A P P L I C A T I O N
+######################################################################
+starlette_app = Starlette(routes=[
+    Route('/orders', OrderCollection),
+    Route('/orders/bulk', OrderBulkResource),
+    Route('/orders/bulk/{action}', OrderBulkTransitionResource),
+    Route('/orders/changes', OrderChangesResource),
+    Route('/orders/events', OrderEventsResource),
+    Route('/orders/reset', orders_reset, methods=['DELETE']),
+    Route('/orders/{order_id:int}', OrderResource),
+    Route('/orders/{order_id:int}/cancel', OrderCancelResource),
+    Route('/orders/products/{product_id:int}', OrderProductListResource),
+    Route('/orders/products/{product_id:int}/summary', OrderProductSummaryResource),
+    Route('/orders/customers/{customer_id:int}', OrderCustomerListResource),
+    Route('/orders/customers/{customer_id:int}/summary', OrderCustomerSummaryResource),
+    Route('/stats/cache', cache_stats),
+    Route('/stats/pool', connection_pool_stats),
+    Route('/health/live', liveness),
+    Route('/health/ready', readiness),
+    Route('/metrics', prometheus_metrics),
+], exception_handlers={
+    HTTPException: http_error,
+    StarletteHTTPException: http_error,
+    status.HTTP_500_INTERNAL_SERVER_ERROR: internal_server_error,
+}, on_startup=[connect], on_shutdown=[disconnect])
+
+# outside of the error middleware of Starlette, to also count its 500s
+app = MetricsMiddleware(starlette_app)
@@ -0,0 +1,288 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Order Cache
+
+Read-through cache of serialized Orders used by Order.find_serialized.
+Every backend has the same interface (get, set, delete, clear, stats) and
+counts its hits, misses and evictions.
+
+Backends
+--------
+NullCache - caches nothing, every lookup goes to the database
+LocalCache - in-process LRU cache bounded in size and in time (TTL)
+SharedCache - keeps the entries in a shared Redis server, so the writes of
+              every worker and every instance invalidate the same entries
+MemoryClient - in-process stand-in for the Redis client of a SharedCache
+
+A read through the cache takes the generation of the cache before it reads
+the database, and passes it to set. Every delete and clear starts a new
+generation, so a reader that loaded an Order before a concurrent write and
+its delete does not cache the older copy after the delete.
+
+A LocalCache is only invalidated by the writes of its own process: with
+several workers or instances, the other processes may serve an Order that
+is up to CACHE_TTL seconds old. So create_cache refuses the local backend
+when WEB_CONCURRENCY is more than 1, unless CACHE_LOCAL_STALE_OK says those
+stale reads are acceptable; use the shared backend otherwise.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+BACKENDS = ('none', 'local', 'shared')
+
+class Cache(object):
+    """ Interface of the cache backends """
+    name = None
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value cached for a key or None """
+        raise NotImplementedError
+
+    def generation(self):
+        """ Returns the number of invalidations so far, to pass to set """
+        raise NotImplementedError
+
+    def set(self, key, value, generation=None):
+        """ Caches a value for a key, unless an invalidation came after the generation """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes the value cached for a key, if any """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every cached value """
+        raise NotImplementedError
+
+    def size(self):
+        """ Returns the number of cached values, or None if it is not known """
+        return None
+
+    def stats(self):
+        """ Returns the counters of the cache as a dictionary """
+        return {"backend": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": self.size()
+               }
+
+    def _count(self, value):
+        """ Counts a lookup as a hit or a miss and returns its value """
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+class NullCache(Cache):
+    """ A cache that never holds anything """
+    name = 'none'
+
+    def get(self, key):
+        return self._count(None)
+
+    def generation(self):
+        return 0
+
+    def set(self, key, value, generation=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def size(self):
+        return 0
+
+class LocalCache(Cache):
+    """
+    In-process LRU cache
+
+    Holds at most maxsize values for at most ttl seconds. The least recently
+    used value is evicted when the cache is full.
+    """
+    name = 'local'
+
+    def __init__(self, maxsize=1024, ttl=10, clock=time.monotonic):
+        super(LocalCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return self._count(None)
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.evictions += 1
+                return self._count(None)
+            self._entries.move_to_end(key)
+            return self._count(value)
+
+    def generation(self):
+        return self._generation
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def size(self):
+        return len(self._entries)
+
+class SharedCache(Cache):
+    """
+    Cache kept in a shared Redis server
+
+    The values are stored as JSON under prefix + key and expire after ttl
+    seconds. Evictions happen in the server and are not counted here. The
+    generation is a counter under prefix + 'generation' that an invalidation
+    increments before it deletes; a set checks it again once it has written,
+    and deletes its value if it changed, as the delete may have come first.
+    """
+    name = 'shared'
+
+    def __init__(self, client, ttl=10, prefix='orders:'):
+        super(SharedCache, self).__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation_key = prefix + 'generation'
+
+    @classmethod
+    def from_url(cls, url, **options):
+        """ Creates a SharedCache for the Redis server at a URL """
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The shared cache needs the redis package: pip install redis')
+        return cls(redis.StrictRedis.from_url(url), **options)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + str(key))
+        return self._count(None if value is None else json.loads(value))
+
+    def generation(self):
+        return int(self.client.get(self.generation_key) or 0)
+
+    def set(self, key, value, generation=None):
+        name = self.prefix + str(key)
+        if generation is not None and generation != self.generation():
+            return
+        self.client.setex(name, self.ttl, json.dumps(value))
+        if generation is not None and generation != self.generation():
+            self.client.delete(name)
+
+    def delete(self, key):
+        self.client.incr(self.generation_key)
+        self.client.delete(self.prefix + str(key))
+
+    def clear(self):
+        self.client.incr(self.generation_key)
+        for name in self.client.scan_iter(match=self.prefix + '*'):
+            # the names are bytes with redis, keep counting the generations
+            if name not in (self.generation_key, self.generation_key.encode('utf-8')):
+                self.client.delete(name)
+
+class MemoryClient(object):
+    """ Stand-in for the subset of the Redis client used by SharedCache """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._values = {}
+
+    def get(self, name):
+        entry = self._values.get(name)
+        if entry is None or entry[0] <= self.clock():
+            self._values.pop(name, None)
+            return None
+        return entry[1]
+
+    def setex(self, name, seconds, value):
+        self._values[name] = (self.clock() + seconds, value.encode('utf-8'))
+
+    def incr(self, name):
+        value = int(self.get(name) or 0) + 1
+        self._values[name] = (float('inf'), str(value).encode('utf-8'))
+        return value
+
+    def delete(self, *names):
+        for name in names:
+            self._values.pop(name, None)
+
+    def scan_iter(self, match=None):
+        prefix = (match or '*').rstrip('*')
+        return [name for name in list(self._values) if name.startswith(prefix)]
+
+def create_cache(config):
+    """
+    Creates the cache backend described by an application configuration
+
+    Args:
+        config (dict): CACHE_BACKEND (none, local or shared), CACHE_SIZE,
+            CACHE_TTL and, for the shared backend, CACHE_URL where memory://
+            selects the in-process MemoryClient
+
+    Raises ValueError for an unknown backend, and for a local one shared by
+    several workers without CACHE_LOCAL_STALE_OK
+    """
+    backend = config.get('CACHE_BACKEND', 'none')
+    ttl = config.get('CACHE_TTL', 10)
+    if backend == 'none':
+        return NullCache()
+    if backend == 'local':
+        workers = config.get('WEB_CONCURRENCY') or 1
+        if workers > 1 and not config.get('CACHE_LOCAL_STALE_OK'):
+            raise ValueError('CACHE_BACKEND local would serve stale Orders with {} workers, '
+                             'use shared or set CACHE_LOCAL_STALE_OK'.format(workers))
+        return LocalCache(maxsize=config.get('CACHE_SIZE', 1024), ttl=ttl)
+    if backend == 'shared':
+        url = config.get('CACHE_URL', 'memory://')
+        if url == 'memory://':
+            return SharedCache(MemoryClient(), ttl=ttl)
+        return SharedCache.from_url(url, ttl=ttl)
+    raise ValueError('Unknown CACHE_BACKEND {}, use one of {}'.format(backend, BACKENDS))
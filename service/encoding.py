@@ -0,0 +1,62 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON Encoding of Order rows
+
+Encodes the plain column tuples returned by Order.paginate_rows straight
+to JSON, without building Order instances. The fastest JSON library that
+is installed is used: orjson, then ujson, then the standard json module.
+Set JSON_ENCODER=json to force the standard module.
+"""
+import os
+import json
+
+ENCODER = os.environ.get('JSON_ENCODER')
+
+if ENCODER in (None, 'orjson'):
+    try:
+        import orjson
+        ENCODER = 'orjson'
+    except ImportError:
+        ENCODER = None
+
+if ENCODER in (None, 'ujson'):
+    try:
+        import ujson
+        ENCODER = 'ujson'
+    except ImportError:
+        ENCODER = None
+
+if ENCODER == 'orjson':
+    def dumps(obj):
+        """ Encodes an object to JSON bytes """
+        return orjson.dumps(obj)
+elif ENCODER == 'ujson':
+    def dumps(obj):
+        """ Encodes an object to JSON bytes """
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+else:
+    ENCODER = 'json'
+    def dumps(obj):
+        """ Encodes an object to JSON bytes """
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def encode_rows(keys, rows):
+    """ Encodes rows of column values as a JSON list of objects """
+    return dumps([dict(zip(keys, row)) for row in rows])
+
+def encode_ndjson(keys, rows):
+    """ Encodes rows of column values as newline delimited JSON objects """
+    return b''.join(dumps(dict(zip(keys, row))) + b'\n' for row in rows)
@@ -0,0 +1,279 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Server-Sent Events of the Order changes
+
+GET /orders/events streams the changes of the change log (see
+Order.changes) to browsers as Server-Sent Events, one event per change:
+
+  id: 42
+  event: update
+  data: {"seq": 42, "operation": "update", "order": {...}, ...}
+
+Each worker process runs one publisher thread that reads the change log
+every CHANGES_POLL_INTERVAL seconds while anyone is subscribed, and hands
+every change to the subscriptions that want it, so the database load does
+not grow with the number of open pages. The log holds the writes of every
+worker, so a page sees all changes whichever worker it is connected to.
+
+A stream ends after EVENT_STREAM_SECONDS, or when its client reads too
+slowly to keep up, and the browser reconnects with the id of the last
+event it got (Last-Event-ID); the changes it missed meanwhile are read
+from the log first.
+"""
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+from service.models import Order, db, MAX_PAGE_SIZE, CHANGES_POLL_INTERVAL
+from service.encoding import dumps
+from service.threads import PerProcessThread
+
+logger = logging.getLogger('flask.app')
+
+EVENT_STREAM_SECONDS = float(os.environ.get('EVENT_STREAM_SECONDS', 300))
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get('EVENT_HEARTBEAT_SECONDS', 15))
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+# how long a browser waits before it reconnects
+EVENT_RETRY_MS = 3000
+
+FILTERS = ('order_id', 'customer_id', 'product_id')
+
+class TooManySubscribers(Exception):
+    """ Used when a worker already streams as many events as it may """
+
+def encode_event(change):
+    """ Encodes a serialized change as a Server-Sent Event """
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (change['seq'],
+                                                 change['operation'].encode(),
+                                                 dumps(change))
+
+def last_event_id(value):
+    """ Returns the seq of a Last-Event-ID header, or None """
+    return int(value) if value and value.isdigit() else None
+
+class Subscription(object):
+    """ The events one client wants, queued until its stream sends them
+
+    Args:
+        order_id, customer_id, product_id (int): only the changes of the
+            Orders that match all of the ones given
+    """
+
+    def __init__(self, order_id=None, customer_id=None, product_id=None):
+        self.criteria = {'id': order_id, 'customer_id': customer_id,
+                         'product_id': product_id}
+        self.queue = queue.Queue(EVENT_QUEUE_SIZE)
+        self.overflowed = False
+
+    def matches(self, order):
+        """ Returns True when the client wants the changes of an Order """
+        return all(value is None or order[key] == value
+                   for key, value in self.criteria.items())
+
+    def offer(self, change, event):
+        """ Queues an event when its Order matches """
+        if self.matches(change['order']):
+            self.put((change['seq'], event))
+
+    def put(self, item):
+        """ Queues an item, or marks the subscription overflowed when it is full """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.overflowed = True
+
+class AsyncSubscription(Subscription):
+    """ A Subscription read by a coroutine of an event loop """
+
+    def __init__(self, loop, **criteria):
+        super(AsyncSubscription, self).__init__(**criteria)
+        self.loop = loop
+        self.queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+
+    def put(self, item):
+        """ Queues an item from the publisher thread """
+        self.loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+class ChangePublisher(PerProcessThread):
+    """ Reads the change log once for all the subscriptions of this process """
+
+    name = 'change-publisher'
+
+    def __init__(self, interval=CHANGES_POLL_INTERVAL):
+        super(ChangePublisher, self).__init__()
+        self.app = None
+        self.interval = interval
+        self.subscriptions = set()
+        self.ready = threading.Event()
+
+    def init_app(self, app):
+        """ Reads the change log with the database of a Flask app """
+        self.app = app
+
+    def subscribe(self, subscription, limit=None):
+        """ Adds a subscription, starting the publisher thread if needed
+
+        Returns once the publisher knows where the log ends, so that the
+        changes the subscription gets live all come after the ones it can
+        read from the log.
+
+        Raises TooManySubscribers when there are already limit subscriptions
+        """
+        with self.lock:
+            if limit is not None and len(self.subscriptions) >= limit:
+                raise TooManySubscribers('{} event streams are open'.format(limit))
+            self.subscriptions.add(subscription)
+            self._start()
+            ready = self.ready
+        ready.wait(EVENT_HEARTBEAT_SECONDS)
+
+    def before_start(self):
+        """ Makes the new thread tell when it knows where the log ends """
+        self.ready = threading.Event()
+
+    def unsubscribe(self, subscription):
+        """ Removes a subscription, the thread stops after the last one """
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def run(self):
+        """ Publishes the new changes until nobody is subscribed """
+        since = None
+        with self.app.app_context():
+            while True:
+                try:
+                    if since is None:
+                        since = Order.last_change()
+                        self.ready.set()
+                    else:
+                        since = self.publish(since)
+                except Exception:   # pylint: disable=broad-except
+                    logger.exception('Could not read the change log')
+                finally:
+                    db.session.remove()
+                with self.lock:
+                    if not self.subscriptions:
+                        self.thread = None
+                        return
+                time.sleep(self.interval)
+
+    def publish(self, since):
+        """ Hands the changes after since to the subscriptions and returns the last seq """
+        while True:
+            rows, since = Order.changes(since, MAX_PAGE_SIZE)
+            with self.lock:
+                subscriptions = list(self.subscriptions)
+            for row in rows:
+                change = Order.serialize_change(row)
+                event = encode_event(change)
+                for subscription in subscriptions:
+                    subscription.offer(change, event)
+            if len(rows) < MAX_PAGE_SIZE:
+                return since
+
+# the publisher of this process
+publisher = ChangePublisher()
+
+def init_app(app):
+    """ Publishes the changes with the database of a Flask app """
+    publisher.init_app(app)
+
+def missed_events(subscription, rows):
+    """ Returns the (seq, event) of the rows of the log a subscription wants """
+    changes = [Order.serialize_change(row) for row in rows]
+    return [(change['seq'], encode_event(change)) for change in changes
+            if subscription.matches(change['order'])]
+
+def wait_for_changes(since, limit, seconds, max_subscribers=None):
+    """ Returns the changes after since, waiting up to seconds for one
+
+    A long poll of GET /orders/changes is woken up by the publisher instead
+    of reading the log every interval, and holds a thread like an event
+    stream, so it is one of the max_subscribers of the worker too. When the
+    worker already has as many, it returns the empty page without waiting.
+
+    Returns:
+        the rows of the changes and the last seq, as Order.changes
+    """
+    rows, last = Order.changes(since, limit)
+    if rows or seconds <= 0:
+        return rows, last
+    # end the transaction, so that the next read sees the changes committed
+    # meanwhile, and give back the connection while waiting
+    db.session.close()
+    subscription = Subscription()
+    try:
+        publisher.subscribe(subscription, max_subscribers)
+    except TooManySubscribers as error:
+        logger.warning('Not waiting for changes: %s', error)
+        return rows, last
+    deadline = time.monotonic() + seconds
+    try:
+        while True:
+            # read once subscribed, so that no change is missed in between
+            rows, last = Order.changes(since, limit)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows, last
+            db.session.close()
+            try:
+                subscription.queue.get(timeout=remaining)
+            except queue.Empty:
+                pass
+    finally:
+        publisher.unsubscribe(subscription)
+
+def stream(subscription, since=None, seconds=EVENT_STREAM_SECONDS):
+    """ Yields the body of an event stream for a subscription
+
+    Args:
+        subscription (Subscription): subscribed to the publisher
+        since (int): the seq of the last event the client got, to send the
+            changes after it from the log first
+        seconds (float): how long the stream lasts
+    """
+    yield b'retry: %d\n\n' % EVENT_RETRY_MS
+    if since is not None:
+        while True:
+            rows, last = Order.changes(since, MAX_PAGE_SIZE)
+            for _, event in missed_events(subscription, rows):
+                yield event
+            since = last
+            if len(rows) < MAX_PAGE_SIZE:
+                break
+        # give back the connection, the stream may last for minutes
+        db.session.close()
+    deadline = time.monotonic() + seconds
+    while not subscription.overflowed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            seq, event = subscription.queue.get(timeout=min(EVENT_HEARTBEAT_SECONDS, remaining))
+        except queue.Empty:
+            yield b': keep-alive\n\n'
+            continue
+        # the changes read from the log can also be queued
+        if since is None or seq > since:
+            yield event
@@ -0,0 +1,161 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Group Commit of the Order creates
+
+When GROUP_COMMIT is set, POST /orders does not commit a transaction of
+its own. The request validates its Order, queues it and waits, while one
+thread of the worker takes the Orders queued within GROUP_COMMIT_WINDOW_MS
+of the first one (at most GROUP_COMMIT_MAX_ROWS) and inserts them all in
+one transaction, like Order.bulk_create. A burst of creates then waits for
+one commit per group instead of one per Order, so the creates per second
+grow with the concurrent requests instead of being capped by the commit
+latency, and the Orders that queue up during a commit form the next group.
+
+Every request still gets its own Order and whether it was created: a uuid
+that already exists, or that another request of the same group posted,
+returns the existing Order as create_or_get does. The Orders are validated
+before they are queued, so a bad one is refused without joining a group.
+When a group cannot be committed anyway, its Orders are inserted again one
+by one, so that only the requests whose own insert fails get an error. A
+create that is alone waits up to the window longer than without group commit.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from service.models import Order, db
+from service.metrics import COMMIT_GROUP_SIZE
+from service.threads import PerProcessThread
+
+logger = logging.getLogger('flask.app')
+
+# how long a create waits for its group, gunicorn restarts a silent worker anyway
+WAIT_SECONDS = float(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+class GroupCommitTimeout(Exception):
+    """ Used when the group of a create was not committed in time """
+
+class PendingCreate(object):
+    """ An Order that waits for its group to be committed """
+
+    def __init__(self, order):
+        self.order = order
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class GroupCommitter(PerProcessThread):
+    """ Commits the Orders created by the requests of this process in groups """
+
+    name = 'group-commit'
+
+    def __init__(self):
+        super(GroupCommitter, self).__init__()
+        self.app = None
+        self.queue = queue.Queue()
+
+    def init_app(self, app):
+        """ Commits with the database and configuration of a Flask app """
+        self.app = app
+
+    def create(self, data):
+        """
+        Creates an Order unless there is already one with the same uuid
+
+        Like Order.create_or_get, but committed together with the creates of
+        the other requests
+
+        Args:
+            data (dict): the Order data
+
+        Returns:
+            a tuple of the Order and whether it was created
+
+        Raises DataValidationError when the data is not a valid Order, and
+        GroupCommitTimeout when its group was not committed in time
+        """
+        pending = PendingCreate(Order().deserialize(data))
+        Order.logger.info('Queueing %s', pending.order.uuid)
+        self.start()
+        self.queue.put(pending)
+        if not pending.done.wait(WAIT_SECONDS):
+            raise GroupCommitTimeout('Order {} was not committed within {} seconds'
+                                     .format(pending.order.uuid, WAIT_SECONDS))
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def before_start(self):
+        """ Drops the creates queued in the process this one forked from """
+        self.queue = queue.Queue()
+
+    def run(self):
+        """ Commits the queued creates, one group after the other """
+        with self.app.app_context():
+            while True:
+                self.commit(self.collect())
+
+    def collect(self):
+        """ Returns the creates queued within the window of the first one """
+        group = [self.queue.get()]
+        max_rows = self.app.config['GROUP_COMMIT_MAX_ROWS']
+        deadline = time.monotonic() + self.app.config['GROUP_COMMIT_WINDOW_MS'] / 1000.0
+        while len(group) < max_rows:
+            remaining = deadline - time.monotonic()
+            try:
+                group.append(self.queue.get(timeout=remaining) if remaining > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def commit(self, group):
+        """ Inserts the Orders of a group in one transaction and wakes up their requests """
+        Order.logger.info('Group committing %s Orders', len(group))
+        try:
+            results = Order.insert_new([pending.order for pending in group])
+        except Exception:     # pylint: disable=broad-except
+            logger.exception('Could not commit a group of %s Orders, committing them one by one',
+                             len(group))
+            db.session.rollback()
+            for pending in group:
+                self.commit_alone(pending)
+        else:
+            for pending, result in zip(group, results):
+                pending.result = result
+            COMMIT_GROUP_SIZE.observe(len(group))
+        finally:
+            db.session.remove()
+            for pending in group:
+                pending.done.set()
+
+    @staticmethod
+    def commit_alone(pending):
+        """ Inserts the Order of a create in a transaction of its own """
+        try:
+            pending.result = Order.insert_new([pending.order])[0]
+        except Exception as error:     # pylint: disable=broad-except
+            logger.exception('Could not commit Order %s', pending.order.uuid)
+            db.session.rollback()
+            pending.error = error
+
+# the group committer of this process
+committer = GroupCommitter()
+
+def init_app(app):
+    """ Commits the creates of a Flask app in groups when it is configured to """
+    committer.init_app(app)
@@ -0,0 +1,220 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Service Metrics
+
+Prometheus metrics of the requests and of the database queries, served
+in the text format by GET /metrics.
+
+Every request is labeled with its method and endpoint, the name of the
+Resource class that handled it (OrderResource, OrderCollection, ...) or
+of the view function, so that the number of series does not grow with
+the ids in the URLs. Requests that match no route are labeled unmatched.
+The latency of a streamed response stops at its first byte.
+
+Every gunicorn worker is its own process with its own counters. When the
+prometheus_multiproc_dir environment variable names a directory (as
+gunicorn_config.py makes sure it does), the workers write their values
+there and /metrics adds them up across the processes.
+
+The ASGI application (service/asgi.py) records the same request metrics
+with a middleware, and counts the statements of its requests with
+timed_query, as the databases package does not go through the events of
+the SQLAlchemy engines.
+
+Statements slower than SLOW_QUERY_MS are logged with their parameters and
+the route that ran them. A Resource method decorated with query_budget(n)
+may run at most n statements per request: a request that runs more is
+logged, and fails with QueryBudgetExceeded when QUERY_BUDGET_STRICT is set,
+as the tests do, so that an N+1 query is caught before it ships.
+"""
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+from flask import g, request, current_app, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, \
+    CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+MULTIPROCESS_DIR = 'prometheus_multiproc_dir'
+# parameters longer than this are cut in the slow query log
+MAX_PARAMETERS_LENGTH = 500
+
+class QueryBudgetExceeded(Exception):
+    """ Used when a request runs more statements than its query budget """
+
+REQUESTS = Counter('orders_http_requests_total',
+                   'HTTP requests by method, endpoint and status code',
+                   ['method', 'endpoint', 'status'])
+LATENCY = Histogram('orders_http_request_duration_seconds',
+                    'Time to answer an HTTP request',
+                    ['method', 'endpoint'],
+                    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+RESPONSE_SIZE = Histogram('orders_http_response_size_bytes',
+                          'Size of the HTTP response bodies',
+                          ['method', 'endpoint'],
+                          buckets=(100, 1000, 10000, 100000, 1000000, 10000000))
+IN_FLIGHT = Gauge('orders_http_requests_in_flight',
+                  'HTTP requests being answered',
+                  multiprocess_mode='livesum')
+QUERIES = Histogram('orders_db_queries_per_request',
+                    'Database statements executed by an HTTP request',
+                    ['method', 'endpoint'],
+                    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+QUERY_TIME = Histogram('orders_db_request_duration_seconds',
+                       'Time an HTTP request spent executing database statements',
+                       ['method', 'endpoint'],
+                       buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+QUERY_DURATION = Histogram('orders_db_query_duration_seconds',
+                           'Time to execute one database statement',
+                           buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1,
+                                    .25, .5, 1, 5))
+COMMIT_GROUP_SIZE = Histogram('orders_db_commit_group_size',
+                              'Orders created by one group commit (see service/group_commit.py)',
+                              buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+# the number and time of the statements of the current ASGI request
+ASYNC_QUERIES = contextvars.ContextVar('orders_async_queries', default=None)
+
+def init_app(app):
+    """ Records the metrics of every request of a Flask app """
+    app.before_request(start_request)
+    app.after_request(end_request)
+    app.teardown_request(teardown_request)
+
+def query_budget(limit):
+    """ Decorates a Resource method with the most statements it may run """
+    def decorator(function):
+        function.query_budget = limit
+        return function
+    return decorator
+
+def handler_of():
+    """ Returns the Resource method or view function that handles the request, or None """
+    if request.url_rule is None:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(getattr(view, 'view_class', None), request.method.lower(), view)
+
+def budget_of():
+    """ Returns the query budget of the method that handles the request, or None """
+    return getattr(handler_of(), 'query_budget', None)
+
+def route_of():
+    """ Returns the method and route of the current request, for the logs """
+    if not has_request_context():
+        return 'no request'
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return '{} {}'.format(request.method, rule)
+
+def endpoint_label():
+    """ Returns the Resource class or view function that handles the request """
+    if request.url_rule is None:
+        return 'unmatched'
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    return view_class.__name__ if view_class else request.endpoint
+
+def start_request():
+    """ Starts the clocks and counters of a request """
+    IN_FLIGHT.inc()
+    g.metrics_start = time.perf_counter()
+    g.queries = 0
+    g.query_time = 0.0
+
+def end_request(response):
+    """ Records the latency, size and queries of a request """
+    if 'metrics_start' not in g:
+        return response
+    method, endpoint = request.method, endpoint_label()
+    REQUESTS.labels(method, endpoint, response.status_code).inc()
+    LATENCY.labels(method, endpoint).observe(time.perf_counter() - g.metrics_start)
+    if response.content_length is not None:
+        RESPONSE_SIZE.labels(method, endpoint).observe(response.content_length)
+    QUERIES.labels(method, endpoint).observe(g.queries)
+    QUERY_TIME.labels(method, endpoint).observe(g.query_time)
+    check_budget()
+    return response
+
+def check_budget():
+    """ Reports a request that ran more statements than its query budget """
+    budget = budget_of()
+    if budget is None or g.queries <= budget:
+        return
+    message = '{} ran {} queries, its budget is {}'.format(route_of(), g.queries, budget)
+    if current_app.config.get('QUERY_BUDGET_STRICT'):
+        raise QueryBudgetExceeded(message)
+    current_app.logger.warning(message)
+
+def teardown_request(error=None):
+    """ Ends a request, even one that failed """
+    if g.pop('metrics_start', None) is not None:
+        IN_FLIGHT.dec()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Starts the clock of a statement """
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Records the duration of a statement, and counts it for the request """
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    QUERY_DURATION.observe(duration)
+    if has_app_context():
+        threshold = current_app.config.get('SLOW_QUERY_MS')
+        if threshold is not None and duration * 1000 >= threshold:
+            current_app.logger.warning('Slow query (%.1f ms) on %s: %s %s', duration * 1000,
+                                       route_of(), ' '.join(statement.split()),
+                                       repr(parameters)[:MAX_PARAMETERS_LENGTH])
+    if has_request_context() and 'queries' in g:
+        g.queries += 1
+        g.query_time += duration
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    """ Stops the clock of a statement that failed """
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+@contextmanager
+def timed_query():
+    """ Times a statement of the ASGI application, and counts it for its request """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        QUERY_DURATION.observe(duration)
+        queries = ASYNC_QUERIES.get()
+        if queries is not None:
+            queries[0] += 1
+            queries[1] += duration
+
+def expose():
+    """ Returns the metrics in the Prometheus text format, and its content type """
+    if MULTIPROCESS_DIR in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+    """ Forgets the live gauges of a worker that exited """
+    if MULTIPROCESS_DIR in os.environ:
+        multiprocess.mark_process_dead(pid)
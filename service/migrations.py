@@ -0,0 +1,255 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Schema Migrations for the Order Service
+
+db.create_all() only creates the tables that are missing, it never changes
+a table that already exists. Changes to existing tables (new indexes, new
+columns) are made by the migrations in this module instead.
+
+Every migration has a version number and is applied at most once: the
+versions that were applied are recorded in the schema_version table and
+upgrade() applies the missing ones in order. Migrations must also work on
+a schema that db.create_all() has just created from the current models,
+so they check what already exists before changing anything, and each
+one only makes the changes it introduced (later migrations may depend on
+running after the earlier ones).
+
+Migrations can be applied at deploy time with:
+  FLASK_APP=service:app flask db-upgrade
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, MetaData, Table
+from service.models import db, Order, order_changes, order_change_lock, BULK_BATCH_SIZE
+
+logger = logging.getLogger('flask.app')
+
+# Records the migrations that were applied to the database
+schema_version = db.Table(
+    'schema_version',
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('description', db.String(255)),
+    db.Column('applied_at', db.DateTime)
+)
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """ Registers a function of a connection as the migration to a version """
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+    return register
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+
+@migration(1, 'Add secondary indexes to the order table')
+def add_order_indexes(connection):
+    """ Creates the lookup indexes on customer, product and status """
+    create_missing_indexes(connection, Order.__table__,
+                           ['ix_order_customer_id_id', 'ix_order_product_id_id',
+                            'ix_order_status'])
+
+@migration(2, 'Add the version column to the order table')
+def add_order_version(connection):
+    """ Adds the version used for ETags, starting every Order at 1 """
+    add_missing_columns(connection, Order.__table__, ['version'])
+
+@migration(3, 'Make the uuid of an order unique')
+def make_order_uuid_unique(connection):
+    """ Replaces the index on uuid by a unique index
+
+    The migration stops if there are already Orders that share a uuid, as
+    only a person can decide which of them to keep.
+    """
+    duplicates = connection.execute(
+        db.select([Order.uuid]).group_by(Order.uuid).having(db.func.count() > 1)
+    ).fetchall()
+    if duplicates:
+        raise RuntimeError('{} uuids are used by more than one order, e.g. {}'.format(
+            len(duplicates), duplicates[0][0]))
+    create_missing_indexes(connection, Order.__table__, ['ux_order_uuid'])
+    drop_index(connection, Order.__tablename__, 'ix_order_uuid')
+
+@migration(4, 'Index the orders of a customer by status')
+def add_order_customer_status_index(connection):
+    """ Creates the index for the open orders of a customer """
+    create_missing_indexes(connection, Order.__table__, ['ix_order_customer_id_status_id'])
+
+@migration(5, 'Add the order change log')
+def add_order_changes(connection):
+    """ Creates the change log, starting it with the creation of every Order
+
+    A follower that reads the log from the start then sees the Orders that
+    existed before the log did.
+    """
+    order_changes.create(connection, checkfirst=True)
+    if connection.execute(db.select([db.func.count()]).select_from(order_changes)).scalar():
+        return
+    logger.info('Logging the creation of the existing Orders')
+    connection.execute(Order.change_statement('create', db.true()))
+
+@migration(6, 'Make the price and quantity of an order NOT NULL')
+def make_order_price_quantity_required(connection):
+    """ Sets the missing prices and quantities to 0 and makes the columns NOT NULL
+
+    The Orders that change get a new version and an update in the change
+    log, like any other write.
+    """
+    missing = db.or_(Order.price.is_(None), Order.quantity.is_(None))
+    ids = [row[0] for row in connection.execute(db.select([Order.id]).where(missing))]
+    if ids:
+        logger.info('Setting the missing price or quantity of %s Orders to 0', len(ids))
+    for start in range(0, len(ids), BULK_BATCH_SIZE):
+        chunk = Order.id.in_(ids[start:start + BULK_BATCH_SIZE])
+        connection.execute(Order.__table__.update().where(chunk).values(
+            price=db.func.coalesce(Order.price, 0), quantity=db.func.coalesce(Order.quantity, 0)))
+        connection.execute(Order.change_statement('update', chunk))
+    make_columns_not_null(connection, Order.__table__, ['price', 'quantity'])
+
+@migration(7, 'Add the lock that orders the writes of the change log')
+def add_order_change_lock(connection):
+    """ Creates the row that the writers of the change log update first, see Order.log_statements """
+    order_change_lock.create(connection, checkfirst=True)
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+def make_columns_not_null(connection, table, names):
+    """ Makes the named columns of a table NOT NULL, as the model declares them
+
+    The columns must not hold a NULL anymore. SQLite cannot change a
+    column, so there the whole table is rebuilt.
+    """
+    nullable = {column['name'] for column in inspect(connection).get_columns(table.name)
+                if column['nullable'] and column['name'] in names}
+    if not nullable:
+        return
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        rebuild_sqlite_table(connection, table)
+        return
+    preparer = connection.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name not in nullable:
+            continue
+        logger.info('Making column %s of %s NOT NULL', column.name, table.name)
+        if dialect == 'mysql':
+            ddl = 'ALTER TABLE {} MODIFY {} {} NOT NULL'.format(
+                preparer.format_table(table), preparer.format_column(column),
+                column.type.compile(connection.dialect))
+        else:
+            ddl = 'ALTER TABLE {} ALTER COLUMN {} SET NOT NULL'.format(
+                preparer.format_table(table), preparer.format_column(column))
+        connection.execute(ddl)
+    if dialect in ('db2', 'ibm_db_sa'):
+        # DB2 only reads a table whose columns were altered once it is reorganized
+        connection.execute("CALL SYSPROC.ADMIN_CMD('REORG TABLE {}')".format(
+            preparer.format_table(table)))
+
+def rebuild_sqlite_table(connection, table):
+    """ Recreates a SQLite table from its model, keeping its rows and its next id """
+    logger.info('Rebuilding %s', table.name)
+    preparer = connection.dialect.identifier_preparer
+    new_table = Table(table.name + '_rebuild', MetaData(),
+                      *[column.copy() for column in table.columns], **table.kwargs)
+    new_table.create(connection)
+    columns = ', '.join(preparer.format_column(column) for column in table.columns)
+    connection.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+        preparer.format_table(new_table), columns, columns, preparer.format_table(table)))
+    sequence = connection.execute('SELECT seq FROM sqlite_sequence WHERE name = ?',
+                                  table.name).scalar()
+    connection.execute('DROP TABLE {}'.format(preparer.format_table(table)))
+    connection.execute('ALTER TABLE {} RENAME TO {}'.format(preparer.format_table(new_table),
+                                                           preparer.format_table(table)))
+    if sequence is not None:
+        connection.execute('DELETE FROM sqlite_sequence WHERE name = ?', table.name)
+        connection.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                           table.name, sequence)
+    for index in table.indexes:
+        index.create(connection)
+
+def drop_index(connection, table_name, index_name):
+    """ Drops an index that is no longer declared on a model, if it exists """
+    table = Table(table_name, MetaData(), autoload_with=connection)
+    for index in table.indexes:
+        if index.name == index_name:
+            logger.info('Dropping index %s on %s', index_name, table_name)
+            index.drop(connection)
+
+def add_missing_columns(connection, table, names):
+    """ Adds the named columns of a table that do not exist in the database
+
+    A column that is NOT NULL needs a server_default to fill the existing rows.
+    """
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name not in names or column.name in existing:
+            continue
+        logger.info('Adding column %s to %s', column.name, table.name)
+        ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(preparer.format_table(table),
+                                                       preparer.format_column(column),
+                                                       column.type.compile(connection.dialect))
+        if column.server_default is not None:
+            ddl += ' DEFAULT {}'.format(column.server_default.arg)
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        connection.execute(ddl)
+
+def create_missing_indexes(connection, table, names):
+    """ Creates the named indexes of a table that do not exist in the database """
+    existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            logger.info('Creating index %s on %s', index.name, table.name)
+            index.create(connection)
+
+def current_version(connection):
+    """ Returns the highest migration version applied to the database """
+    schema_version.create(connection, checkfirst=True)
+    version = connection.execute(db.select([db.func.max(schema_version.c.version)])).scalar()
+    return version or 0
+
+def upgrade(engine):
+    """
+    Applies the migrations that are newer than the database schema
+
+    Args:
+        engine (Engine): the engine of the database to upgrade
+
+    Returns:
+        the version of the database schema after the upgrade
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+        for number, description, function in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info('Applying migration %s: %s', number, description)
+            with connection.begin():
+                function(connection)
+                connection.execute(schema_version.insert(),
+                                   version=number,
+                                   description=description,
+                                   applied_at=datetime.utcnow())
+            version = number
+    logger.info('Database schema is at version %s', version)
+    return version
@@ -32,21 +32,63 @@ quantity (integer) : number of products items in the order
 """
 import os
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from sqlalchemy import DDL, event
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from service.cache import NullCache, create_cache
+from service.pool import engine_options
+from service.replicas import RoutingSQLAlchemy
 from retry import retry
 from requests import HTTPError
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# reads of the read-only requests may go to a replica (see service/replicas.py)
+db = RoutingSQLAlchemy()
 
 RETRY_COUNT = int(os.environ.get('RETRY_COUNT', 10))
 RETRY_DELAY = int(os.environ.get('RETRY_DELAY', 1))
 RETRY_BACKOFF = int(os.environ.get('RETRY_BACKOFF', 2))
 
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 10000))
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 0.5))
+MAX_CHANGES_WAIT = int(os.environ.get('MAX_CHANGES_WAIT', 30))
+
+STATUSES = ('In Progress', 'Delivered', 'Cancelled')
+
+# The longest uuid an Order can have, the size of its column
+UUID_LENGTH = 63
+# The largest value of an INTEGER column in MySQL, PostgreSQL and DB2
+MAX_INTEGER = 2 ** 31 - 1
+
+# What happened to an Order, in the change log
+OPERATIONS = ('create', 'update', 'delete')
+
+# The columns a list of Orders can be sorted by
+SORT_KEYS = ('id', 'price', 'quantity')
+
+# The statuses an Order can be moved to, with the statuses it can move from
+TRANSITIONS = {
+    'Delivered': ('In Progress',),
+    'Cancelled': ('In Progress',),
+}
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+class TransitionError(Exception):
+    """ Used when an Order cannot move from its status to another one """
+    pass
+
+class VersionConflictError(Exception):
+    """ Used when an Order is no longer at the version a client expects """
+    pass
+
 class Order(db.Model):
     """
     Class that represents an Order
@@ -56,31 +98,71 @@ class Order(db.Model):
     """
     logger = logging.getLogger('flask.app')
     app = None
+    cache = NullCache()
+
+    # Secondary indexes: the (x, id) pairs serve both the lookups by
+    # customer or product and the keyset pages that are ordered by id.
+    # Indexes added here must also be added to an existing schema with a
+    # migration in service/migrations.py
+    __table_args__ = (
+        db.Index('ix_order_customer_id_id', 'customer_id', 'id'),
+        db.Index('ix_order_product_id_id', 'product_id', 'id'),
+        db.Index('ix_order_customer_id_status_id', 'customer_id', 'status', 'id'),
+        db.Index('ux_order_uuid', 'uuid', unique=True),
+        db.Index('ix_order_status', 'status'),
+        # never reuse the id of a deleted Order, or its ETag could match
+        {'sqlite_autoincrement': True}
+    )
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    uuid = db.Column(db.String(63))
+    uuid = db.Column(db.String(UUID_LENGTH))
     product_id = db.Column(db.Integer)
     customer_id = db.Column(db.Integer)
-    price = db.Column(db.Integer)
-    quantity = db.Column(db.Integer)
-    status = db.Column(db.Enum('In Progress', 'Delivered', 'Cancelled'))
+    # the keyset of the pages sorted by price or quantity cannot hold a NULL
+    price = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.Enum(*STATUSES))
+    # incremented by every UPDATE, ORM or not, and used as the ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1',
+                        onupdate=db.literal_column('version') + 1)
+
+    # ORM updates are compare-and-swap too: save() only changes the row if it
+    # is still at the version that was loaded and raises StaleDataError if not
+    __mapper_args__ = {'version_id_col': version}
 
 
     def save(self):
         """
         Saves a Order to the data store
+
+        Raises VersionConflictError when the Order was changed by someone
+        else since it was loaded
         """
         Order.logger.info('Saving %s', self.uuid)
+        operation = 'update'
         if not self.id:
             db.session.add(self)
-        db.session.commit()
+            operation = 'create'
+        try:
+            db.session.flush()
+            for statement in Order.log_statements(operation, [Order.id == self.id]):
+                db.session.execute(statement)
+            db.session.commit()
+        except StaleDataError as error:
+            db.session.rollback()
+            raise VersionConflictError(str(error))
+        Order.cache.delete(self.id)
 
     def delete(self):
         """ Removes a Order from the data store """
         Order.logger.info('Deleting %s', self.uuid)
+        order_id = self.id
+        for statement in Order.log_statements('delete', [Order.id == order_id]):
+            db.session.execute(statement)
         db.session.delete(self)
         db.session.commit()
+        Order.cache.delete(order_id)
 
     def serialize(self):
         """ Serializes a Order into a dictionary """
@@ -90,13 +172,17 @@ class Order(db.Model):
                 "product_id": self.product_id,
                 "price": self.price,
                 "quantity": self.quantity,
-                "status": self.status
+                "status": self.status,
+                "version": self.version
                 }
 
     def deserialize(self, data):
         """
         Deserializes a Order from a dictionary
 
+        The values are checked here, so that a bad Order is refused with a
+        DataValidationError before it reaches the database
+
         Args:
             data (dict): A dictionary containing the Order data
         """
@@ -110,17 +196,459 @@ class Order(db.Model):
         except KeyError as error:
             raise DataValidationError('Invalid order: missing ' + error.args[0])
         except TypeError as error:
-            raise DataValidationError('Invalid order: body of request contained' \
+            raise DataValidationError('Invalid order: body of request contained ' \
                                       'bad or no data')
+        if not isinstance(self.uuid, str) or not 0 < len(self.uuid) <= UUID_LENGTH:
+            raise DataValidationError('Invalid order: uuid must be a string of 1 to {} '
+                                      'characters'.format(UUID_LENGTH))
+        for name in ('customer_id', 'product_id', 'price', 'quantity'):
+            value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise DataValidationError('Invalid order: {} must be an integer, not {!r}'
+                                          .format(name, value))
+            if name in ('price', 'quantity') and value < 0:
+                raise DataValidationError('Invalid order: {} must not be negative'.format(name))
+            if value > MAX_INTEGER:
+                raise DataValidationError('Invalid order: {} must be at most {}'
+                                          .format(name, MAX_INTEGER))
+        if self.status not in STATUSES:
+            raise DataValidationError('Invalid order: status must be one of {}, not {!r}'
+                                      .format(', '.join(STATUSES), self.status))
         return self
 
+    @staticmethod
+    def version_of(data):
+        """
+        Returns the version in the data of an Order, or None when it has none
+
+        Raises DataValidationError when the version is not a positive integer
+        """
+        if not isinstance(data, dict) or data.get('version') is None:
+            return None
+        version = data['version']
+        if isinstance(version, bool) or not isinstance(version, int) or version < 1:
+            raise DataValidationError('Invalid order: version must be a positive integer, '
+                                      'not {!r}'.format(version))
+        return version
+
+    @staticmethod
+    def is_duplicate_uuid(error):
+        """
+        Returns True when a database error is a violation of the unique uuid
+
+        Args:
+            error: a SQLAlchemy IntegrityError, or the error of a driver
+
+        Every other constraint violation is a real error, not a repeated
+        create. The drivers name the ux_order_uuid index or the uuid column
+        in their message, except DB2 that only gives the SQLSTATE of a
+        unique violation, which on this table can only be the uuid.
+        """
+        orig = getattr(error, 'orig', error)
+        name = type(orig).__name__
+        if 'IntegrityError' not in name and 'UniqueViolation' not in name:
+            return False
+        message = str(orig)
+        return 'uuid' in message.lower() or 'SQLSTATE=23505' in message
+
+    def columns(self):
+        """ Returns the column values of a new Order, without id and version """
+        return {column.name: getattr(self, column.name)
+                for column in self.__table__.columns if column.name not in ('id', 'version')}
+
     @classmethod
-    def init_db(cls, app):
-        """ Initializes the database session """
-        cls.logger.info('Initializing database')
+    def create_or_get(cls, data):
+        """
+        Creates an Order unless there is already one with the same uuid
+
+        The uuid is the idempotency key of a create: a client that retries a
+        create after a timeout gets back the Order it created the first time.
+        The insert is tried first and the unique index on uuid catches the
+        repeats, so a new Order costs no extra lookup. The new Order is built
+        from the values it was inserted with, not reloaded after the commit.
+
+        Args:
+            data (dict): the Order data, validated with deserialize
+
+        Returns:
+            a tuple of the Order and whether it was created
+        """
+        values = cls().deserialize(data).columns()
+        cls.logger.info('Creating %s', values['uuid'])
+        try:
+            result = db.session.execute(cls.__table__.insert().values(version=1, **values))
+            order_id = result.inserted_primary_key[0]
+            for statement in cls.log_statements('create', [cls.id == order_id]):
+                db.session.execute(statement)
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            existing = cls.find_by_uuid(values['uuid']) if cls.is_duplicate_uuid(error) else None
+            if existing is None:
+                raise
+            cls.logger.info('Order %s already exists', values['uuid'])
+            return existing, False
+        return cls(id=order_id, version=1, **values), True
+
+    @classmethod
+    def bulk_create(cls, items, batch_size=BULK_BATCH_SIZE):
+        """
+        Creates many Orders in a single transaction
+
+        Every item is validated with deserialize. The valid ones are inserted
+        batch_size rows per executemany and committed once; the invalid ones
+        are skipped and reported in their place in the results. Like
+        create_or_get, an item whose uuid already exists (in the database or
+        earlier in the items) is not inserted again.
+
+        Args:
+            items (list): the dictionaries of the Orders to create
+            batch_size (int): the number of rows per INSERT statement
+
+        Returns:
+            a list with, for each item, either a tuple of the Order and
+            whether it was created, or the DataValidationError that explains
+            why it was not created
+        """
+        cls.logger.info('Bulk creating %s Orders', len(items))
+        orders = []
+        for item in items:
+            try:
+                orders.append(cls().deserialize(item))
+            except DataValidationError as error:
+                orders.append(error)
+        return cls.insert_new(orders, batch_size)
+
+    @classmethod
+    def insert_new(cls, orders, batch_size=BULK_BATCH_SIZE):
+        """
+        Inserts the Orders whose uuid does not exist yet in a single transaction
+
+        Args:
+            orders (list): deserialized Orders, or errors that are passed through
+            batch_size (int): the number of rows per INSERT statement
+
+        Returns:
+            a list with, for each Order, a tuple of the Order and whether it was
+            created, or the error it was given in its place
+        """
+        try:
+            return cls._bulk_insert(orders, batch_size)
+        except IntegrityError as error:
+            if not cls.is_duplicate_uuid(error):
+                raise
+            # another request created one of the uuids in the meantime,
+            # which the lookup of the existing Orders finds the second time
+            return cls._bulk_insert(orders, batch_size)
+
+    @classmethod
+    def _bulk_insert(cls, orders, batch_size):
+        """ Inserts the Orders whose uuid does not exist yet, see bulk_create """
+        existing = []
+        try:
+            for query in cls.existing_statements(orders, batch_size):
+                existing.extend(cls(**dict(row)) for row in db.session.execute(query))
+            results, created = cls.plan_insert(orders, existing)
+            logged = []
+            for start in range(0, len(created), batch_size):
+                batch = created[start:start + batch_size]
+                db.session.execute(cls.__table__.insert(), [order.columns() for order in batch])
+                rows = db.session.execute(cls.ids_statement(batch)).fetchall()
+                logged.append(cls.inserted(batch, rows))
+            if logged:
+                for statement in cls.log_statements('create', logged):
+                    db.session.execute(statement)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        return results
+
+    @classmethod
+    def existing_statements(cls, orders, batch_size=BULK_BATCH_SIZE):
+        """ Returns the SELECTs of the Orders that have the uuid of a new one, see plan_insert """
+        uuids = list({order.uuid for order in orders if isinstance(order, cls)})
+        return [cls.__table__.select().where(cls.uuid.in_(uuids[start:start + batch_size]))
+                for start in range(0, len(uuids), batch_size)]
+
+    @classmethod
+    def plan_insert(cls, orders, existing):
+        """
+        Decides which new Orders a bulk create inserts
+
+        An Order whose uuid exists, in the database or earlier in the
+        list, is not inserted again.
+
+        Args:
+            orders (list): deserialized Orders, or errors that are passed through
+            existing (list): the Orders read by existing_statements
+
+        Returns:
+            a tuple of the results of bulk_create and of the Orders to insert
+        """
+        existing = {order.uuid: order for order in existing}
+        results = []
+        created = []
+        for order in orders:
+            if not isinstance(order, cls):
+                results.append(order)
+            elif order.uuid in existing:
+                results.append((existing[order.uuid], False))
+            else:
+                existing[order.uuid] = order
+                created.append(order)
+                results.append((order, True))
+        return results, created
+
+    @classmethod
+    def ids_statement(cls, orders):
+        """ Returns the SELECT of the uuids and ids of Orders just inserted """
+        # executemany does not return the new ids, so they are read back
+        # with one lookup on the unique uuids
+        return db.select([cls.uuid, cls.id]).where(cls.uuid.in_([order.uuid for order in orders]))
+
+    @classmethod
+    def inserted(cls, orders, rows):
+        """ Sets the ids read by ids_statement and returns the clause to log their creates """
+        ids = {row[0]: row[1] for row in rows}
+        for order in orders:
+            order.id = ids[order.uuid]
+            order.version = 1
+        return cls.id.in_(list(ids.values()))
+
+    @classmethod
+    def bulk_transition(cls, new_status, ids=None, customer_id=None, product_id=None,
+                        status=None):
+        """
+        Moves many Orders to a new status with a single UPDATE statement
+
+        The Orders are selected by id and/or by customer, product and current
+        status. Only the Orders whose status can legally move to new_status
+        are changed; the rows are never loaded into the ORM.
+
+        Args:
+            new_status (string): the status to move the Orders to
+            ids (list): only change the Orders with these ids
+            customer_id (int): only change the Orders of this customer
+            product_id (int): only change the Orders of this product
+            status (string): only change the Orders with this current status
+
+        Returns:
+            the ids of the Orders that were changed
+        """
+        condition = cls.bulk_condition(new_status, ids, customer_id, product_id, status)
+        cls.logger.info('Bulk moving Orders to %s', new_status)
+        try:
+            changed = [row[0] for row in db.session.execute(cls.lock_statement(condition))]
+            for statement in cls.bulk_transition_statements(changed, new_status):
+                db.session.execute(statement)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        for order_id in changed:
+            cls.cache.delete(order_id)
+        return changed
+
+    @classmethod
+    def lock_statement(cls, condition):
+        """ Returns the SELECT ... FOR UPDATE of the ids of the Orders that match a condition """
+        return db.select([cls.id]).where(condition).order_by(cls.id).with_for_update()
+
+    @classmethod
+    def bulk_transition_statements(cls, ids, new_status):
+        """
+        Returns the statements that move the Orders with the ids to a new status
+
+        The UPDATEs name the ids that were locked instead of repeating the
+        condition, which a row committed since could also match, BULK_BATCH_SIZE
+        ids at a time, and are followed by the log_statements of every Order
+        they update
+        """
+        chunks = [cls.id.in_(ids[start:start + BULK_BATCH_SIZE])
+                  for start in range(0, len(ids), BULK_BATCH_SIZE)]
+        if not chunks:
+            return []
+        return [cls.__table__.update().where(chunk).values(status=new_status)
+                for chunk in chunks] + cls.log_statements('update', chunks)
+
+    @classmethod
+    def bulk_condition(cls, new_status, ids=None, customer_id=None, product_id=None,
+                       status=None):
+        """ Returns the WHERE clause of bulk_transition or raises DataValidationError """
+        if new_status not in TRANSITIONS:
+            raise DataValidationError('Invalid status: ' + str(new_status))
+        if ids is None and customer_id is None and product_id is None:
+            raise DataValidationError('Select the orders by ids, customer_id or product_id')
+        criteria = [cls.status.in_(TRANSITIONS[new_status])]
+        if ids is not None:
+            criteria.append(cls.id.in_(ids))
+        if customer_id is not None:
+            criteria.append(cls.customer_id == customer_id)
+        if product_id is not None:
+            criteria.append(cls.product_id == product_id)
+        if status is not None:
+            criteria.append(cls.status == status)
+        return db.and_(*criteria)
+
+    @classmethod
+    def transition(cls, order_id, new_status, versions=None):
+        """
+        Moves one Order to a new status with a single conditional UPDATE
+
+        The UPDATE only matches when the current status can legally move to
+        new_status, so concurrent transitions of the same Order cannot both
+        succeed and no read is needed before the write.
+
+        Args:
+            order_id (int): the id of the Order to change
+            new_status (string): the status to move the Order to
+            versions (list): only change the Order if it is at one of these
+                versions (None to change it at any version)
+
+        Returns:
+            the updated Order, or None when there is no Order with the id
+
+        Raises:
+            VersionConflictError: when the Order is not at one of the versions
+            TransitionError: when the Order cannot move to new_status
+        """
+        cls.logger.info('Moving Order %s to %s', order_id, new_status)
+        condition = cls.update_condition(versions, new_status)
+        order, current = cls._update_where(order_id, condition, status=new_status)
+        if order is not None or current is None:
+            return order
+        cls.refuse_update(order_id, current, versions, new_status)
+
+    @classmethod
+    def replace(cls, order_id, data, versions=None):
+        """
+        Replaces the data of an Order with a compare-and-swap UPDATE
+
+        The Order is not read first: one UPDATE ... WHERE id = ? AND
+        version IN (?) both checks the version and writes the new data, so
+        concurrent writers never silently overwrite each other and no lock
+        is held between a read and a write.
+
+        Args:
+            order_id (int): the id of the Order to change
+            data (dict): the new Order data, validated with deserialize
+            versions (list): only change the Order if it is at one of these
+                versions (None to change it at any version)
+
+        Returns:
+            the updated Order, or None when there is no Order with the id
+
+        Raises:
+            DataValidationError: when the data is not a valid Order
+            VersionConflictError: when the Order is not at one of the versions
+        """
+        cls.logger.info('Replacing Order %s', order_id)
+        values = cls().deserialize(data).columns()
+        condition = cls.update_condition(versions)
+        order, current = cls._update_where(order_id, condition, **values)
+        if order is not None or current is None:
+            return order
+        cls.refuse_update(order_id, current, versions)
+
+    @classmethod
+    def update_condition(cls, versions=None, new_status=None):
+        """ Returns the condition of the UPDATE of a replace or a transition """
+        condition = db.true() if new_status is None else cls.status.in_(TRANSITIONS[new_status])
+        if versions is not None:
+            condition = db.and_(condition, cls.version.in_(versions))
+        return condition
+
+    @classmethod
+    def update_statement(cls, order_id, condition, **values):
+        """ Returns the UPDATE of an Order that only matches it under a condition """
+        return cls.__table__.update().where(db.and_(cls.id == order_id, condition)) \
+            .values(**values)
+
+    @staticmethod
+    def refuse_update(order_id, current, versions=None, new_status=None):
+        """
+        Raises the error of an update whose UPDATE did not match the Order
+
+        Args:
+            order_id (int): the id of the Order
+            current: the current status and version of the Order
+            versions (list): the versions the Order had to be at, or None
+            new_status (string): the status it moves to, or None for a replace
+
+        Raises:
+            VersionConflictError: when the Order is not at one of the versions,
+                or a replace did not match
+            TransitionError: when a transition did not match
+        """
+        if versions is not None and current['version'] not in versions:
+            raise VersionConflictError('Order {} is at version {}'.format(order_id,
+                                                                         current['version']))
+        if new_status is not None:
+            raise TransitionError('Order {} is {} and cannot be {}'.format(
+                order_id, current['status'], new_status))
+        raise VersionConflictError('Order {} is at version {}'.format(order_id,
+                                                                     current['version']))
+
+    @classmethod
+    def _update_where(cls, order_id, condition, **values):
+        """
+        Updates an Order when it also matches a condition
+
+        Returns:
+            a tuple of the updated Order (or None when nothing was updated)
+            and, when nothing was updated, the current status and version of
+            the Order (or None when there is no Order with the id)
+        """
+        table = cls.__table__
+        update = cls.update_statement(order_id, condition, **values)
+        current = None
+        try:
+            if db.session.bind.dialect.name == 'postgresql':
+                # one round trip: the UPDATE returns the new row itself
+                row = db.session.execute(update.returning(*table.columns)).first()
+            elif db.session.execute(update).rowcount:
+                row = db.session.execute(table.select().where(cls.id == order_id)).first()
+            else:
+                row = None
+            if row is not None:
+                for statement in cls.log_statements('update', [cls.id == order_id]):
+                    db.session.execute(statement)
+            else:
+                current = db.session.execute(db.select([cls.status, cls.version])
+                                             .where(cls.id == order_id)).first()
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        if row is None:
+            return None, current
+        cls.cache.delete(order_id)
+        return cls(**dict(row)), None
+
+    @classmethod
+    def cancel(cls, order_id, versions=None):
+        """ Cancels an Order, see transition """
+        return cls.transition(order_id, 'Cancelled', versions)
+
+    @classmethod
+    def init_app(cls, app):
+        """ Configures the database session without connecting to the database
+
+        The engine connects on the first request that uses it, so a worker
+        starts without waiting on the database.
+        """
         cls.app = app
+        cls.cache = create_cache(app.config)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+
+    @classmethod
+    def init_db(cls, app):
+        """ Initializes the database session and creates the tables """
+        cls.logger.info('Initializing database')
+        cls.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
 
@@ -129,7 +657,16 @@ class Order(db.Model):
            logger=logger)
     def remove_all(cls):
         """ Removes all documents from the database (use for testing)  """
-        cls.query.delete()
+        for statement in cls.delete_statements(db.true()):
+            db.session.execute(statement)
+        db.session.commit()
+        cls.cache.clear()
+
+    @classmethod
+    def delete_statements(cls, whereclause):
+        """ Returns the statements that log the deletes and delete the matching Orders """
+        return cls.log_statements('delete', [whereclause]) + \
+            [cls.__table__.delete().where(whereclause)]
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
@@ -139,12 +676,302 @@ class Order(db.Model):
         cls.logger.info('Processing all Orders')
         return cls.query.all()
 
+    @classmethod
+    def paginate_rows(cls, query=None, after=None, limit=PAGE_SIZE, sort='id',
+                      descending=False):
+        """ Returns one page of Orders as plain rows using keyset pagination
+
+        Only ``limit + 1`` rows are read, no matter how large the table is,
+        because the page starts right after the last row of the previous
+        page instead of skipping over an offset. This is the read-only fast
+        path of the list endpoints: the columns are selected with SQLAlchemy
+        Core, so no Order instance is built, instrumented or added to the
+        session.
+
+        Pages can also be sorted by price or quantity, in which case the
+        keyset is the pair (sort column, id) and after is such a pair.
+
+        Args:
+            query (Query): the query to page through (defaults to all Orders)
+            after: the keyset of the last row of the previous page
+            limit (int): the maximum number of Orders in the page
+            sort (string): the column to sort by, one of SORT_KEYS
+            descending (bool): sort from the largest value to the smallest
+
+        Returns:
+            a tuple of the rows in the page, with their values in the order
+            of Order.column_names(), and the keyset to continue after
+        """
+        statement = cls.page_statement(query.whereclause if query is not None else None,
+                                       after, limit, sort, descending)
+        return cls.page_of(db.session.execute(statement).fetchall(), limit, sort)
+
+    @classmethod
+    def page_statement(cls, whereclause=None, after=None, limit=PAGE_SIZE, sort='id',
+                       descending=False):
+        """ Returns the Core SELECT of a page of rows, see paginate_rows
+
+        The statement reads limit + 1 rows, so that page_of can tell if
+        there is a next page.
+        """
+        if sort not in SORT_KEYS:
+            raise DataValidationError('Invalid sort: ' + str(sort))
+        column = getattr(cls, sort)
+        statement = db.select(list(cls.__table__.columns))
+        if whereclause is not None:
+            statement = statement.where(whereclause)
+        if sort == 'id':
+            order_by = [column.desc() if descending else column]
+            if after is not None:
+                statement = statement.where(column < after if descending else column > after)
+        else:
+            order_by = [column.desc(), cls.id.desc()] if descending else [column, cls.id]
+            if after is not None:
+                value, order_id = after
+                beyond = (column < value, cls.id < order_id) if descending \
+                    else (column > value, cls.id > order_id)
+                statement = statement.where(db.or_(beyond[0],
+                                                   db.and_(column == value, beyond[1])))
+        return statement.order_by(*order_by).limit(limit + 1)
+
+    @staticmethod
+    def page_of(rows, limit, sort='id'):
+        """ Splits the rows read by page_statement into a page and its keyset """
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, last['id'] if sort == 'id' else [last[sort], last['id']]
+
+    @classmethod
+    def summarize(cls, query=None):
+        """
+        Aggregates the Orders of a query in the database
+
+        A single GROUP BY status computes the counts and totals, so the
+        Orders themselves never leave the database.
+
+        Args:
+            query (Query): the Orders to aggregate (defaults to all Orders)
+
+        Returns:
+            a dictionary with the count, total_quantity and total_value
+            (price * quantity) of the Orders, overall and by status
+        """
+        statement = cls.summary_statement(query.whereclause if query is not None else None)
+        return cls.summary_of(db.session.execute(statement))
+
+    @classmethod
+    def summary_statement(cls, whereclause=None):
+        """ Returns the Core GROUP BY statement of summarize """
+        statement = db.select([cls.status,
+                               db.func.count(cls.id),
+                               db.func.sum(cls.quantity),
+                               db.func.sum(cls.price * cls.quantity)])
+        if whereclause is not None:
+            statement = statement.where(whereclause)
+        return statement.group_by(cls.status)
+
+    @staticmethod
+    def summary_of(rows):
+        """ Adds up the (status, count, quantity, value) rows of summary_statement """
+        summary = {"count": 0, "total_quantity": 0, "total_value": 0, "by_status": {}}
+        for status, count, quantity, value in rows:
+            group = {"count": count,
+                     "total_quantity": int(quantity or 0),
+                     "total_value": int(value or 0)}
+            summary["by_status"][status] = group
+            for key in ("count", "total_quantity", "total_value"):
+                summary[key] += group[key]
+        return summary
+
+    @classmethod
+    def column_names(cls):
+        """ Returns the names of the columns of the rows from paginate_rows """
+        return cls.__table__.columns.keys()
+
+    @classmethod
+    def change_statement(cls, operation, whereclause):
+        """ Returns the INSERT that logs the current state of the matching Orders
+
+        Every write adds it to its own transaction, after an insert or an
+        update and before a delete, so the change log can never disagree
+        with the order table.
+
+        Args:
+            operation (string): what happened to the Orders (see OPERATIONS)
+            whereclause: selects the Orders that changed
+        """
+        names = cls.column_names()
+        query = db.select([db.literal(operation), db.literal(datetime.utcnow(), db.DateTime)] +
+                          [cls.__table__.c[name] for name in names]) \
+            .where(whereclause).order_by(cls.id)
+        return order_changes.insert().from_select(
+            ['operation', 'changed_at'] + ['order_' + name if name == 'id' else name
+                                           for name in names], query)
+
+    @classmethod
+    def log_statements(cls, operation, whereclauses):
+        """ Returns the statements that log the changes of a transaction, the last before its commit
+
+        The first one updates the row of order_change_lock, which the
+        transaction then holds until it commits. So the transactions write
+        the log one after the other, each one gets seqs above those of the
+        ones that committed before it, and a reader that sees a seq has
+        already seen every lower one that will ever be committed: a gap is
+        a rolled back transaction, never one that is still running, however
+        long it takes.
+
+        Args:
+            operation (string): what happened to the Orders (see OPERATIONS)
+            whereclauses (list): each selects some of the Orders that changed
+        """
+        lock = order_change_lock.update().values(written_at=datetime.utcnow())
+        return [lock] + [cls.change_statement(operation, whereclause)
+                         for whereclause in whereclauses]
+
+    @classmethod
+    def changes_statement(cls, since, limit):
+        """ Returns the SELECT of the changes after a sequence number, oldest first """
+        return order_changes.select().where(order_changes.c.seq > since) \
+            .order_by(order_changes.c.seq).limit(limit)
+
+    @staticmethod
+    def changes_of(rows, since):
+        """ Returns the rows of the change log and the last seq read
+
+        The writes of the log commit in the order of their seqs (see
+        log_statements), so the rows after a gap can be read at once.
+        """
+        return rows, rows[-1]['seq'] if rows else since
+
+    @classmethod
+    def last_change(cls):
+        """ Returns the seq of the last change in the log, 0 when it is empty """
+        query = db.select([db.func.max(order_changes.c.seq)])
+        return db.session.execute(query).scalar() or 0
+
+    @classmethod
+    def changes(cls, since=0, limit=PAGE_SIZE):
+        """ Returns the changes after a sequence number and the last seq read """
+        rows = db.session.execute(cls.changes_statement(since, limit)).fetchall()
+        return cls.changes_of(rows, since)
+
+    @staticmethod
+    def serialize_change(row):
+        """ Serializes a row of the change log into a dictionary """
+        return {'seq': row['seq'],
+                'operation': row['operation'],
+                'changed_at': row['changed_at'].isoformat() + 'Z',
+                'order': {name: row['order_id' if name == 'id' else name]
+                          for name in Order.column_names()}}
+
+    @classmethod
+    def iterate(cls, query=None, after=None, batch_size=STREAM_BATCH_SIZE, sort='id',
+                descending=False):
+        """ Iterates over every Order of a query in batches of rows
+
+        Each batch is its own keyset page from paginate_rows, so only one
+        batch is held in memory at a time however many Orders the query
+        matches.
+
+        Args:
+            query (Query): the query to iterate (defaults to all Orders)
+            after (int): only return Orders with an id greater than this
+            batch_size (int): the number of Orders fetched per round trip
+            sort (string): the column to sort by, see paginate_rows
+            descending (bool): sort from the largest value to the smallest
+
+        Yields:
+            lists of at most batch_size rows, in sort order
+        """
+        while True:
+            rows, after = cls.paginate_rows(query, after, batch_size, sort, descending)
+            if rows:
+                yield rows
+            if after is None:
+                return
+
     @staticmethod
     def find(order_id):
         """ Finds a Order by it's ID """
         Order.logger.info('Processing lookup for id %s ...', order_id)
         return Order.query.get(order_id)
 
+    @classmethod
+    def find_by_uuid(cls, order_uuid):
+        """ Finds the Order with a uuid, or None """
+        cls.logger.info('Processing lookup for uuid %s ...', order_uuid)
+        return cls.query.filter(cls.uuid == order_uuid).first()
+
+    @classmethod
+    def search(cls, customer_id=None, product_id=None, status=None, min_price=None,
+               max_price=None, min_quantity=None, max_quantity=None):
+        """ Returns the Orders that match every criteria that is given
+
+        Args:
+            customer_id (int): the customer of the Orders
+            product_id (int): the product of the Orders
+            status (string): the status of the Orders
+            min_price, max_price (int): the range of the unit price, inclusive
+            min_quantity, max_quantity (int): the range of the quantity, inclusive
+        """
+        cls.logger.info('Processing search query ...')
+        return cls.query.filter(*cls.search_criteria(customer_id, product_id, status,
+                                                     min_price, max_price,
+                                                     min_quantity, max_quantity))
+
+    @classmethod
+    def search_criteria(cls, customer_id=None, product_id=None, status=None, min_price=None,
+                        max_price=None, min_quantity=None, max_quantity=None):
+        """ Returns the list of WHERE clauses of search """
+        criteria = []
+        if customer_id is not None:
+            criteria.append(cls.customer_id == customer_id)
+        if product_id is not None:
+            criteria.append(cls.product_id == product_id)
+        if status is not None:
+            criteria.append(cls.status == status)
+        if min_price is not None:
+            criteria.append(cls.price >= min_price)
+        if max_price is not None:
+            criteria.append(cls.price <= max_price)
+        if min_quantity is not None:
+            criteria.append(cls.quantity >= min_quantity)
+        if max_quantity is not None:
+            criteria.append(cls.quantity <= max_quantity)
+        return criteria
+
+    @classmethod
+    def find_serialized(cls, order_id):
+        """
+        Finds the serialized Order with an id, reading through the cache
+
+        Writes through save, delete and the transitions invalidate the
+        cached Order, so this is only for read-only uses of the Order. An
+        Order read from a replica is not cached, as the replica may not have
+        the latest write yet and would keep it cached after the invalidation.
+
+        The row is read without loading an Order into the session, so that
+        a request that only compares the version (an If-None-Match) costs no
+        more than that one SELECT.
+
+        Returns:
+            the serialized Order, or None when there is no Order with the id
+        """
+        data = cls.cache.get(order_id)
+        if data is None:
+            # a write that is invalidated while the Order is read is not overwritten
+            generation = cls.cache.generation()
+            cls.logger.info('Processing lookup for id %s ...', order_id)
+            row = db.session.execute(cls.__table__.select().where(cls.id == order_id)).first()
+            if row is None:
+                return None
+            data = dict(row)
+            if db.session.info.get('replica') is None:
+                cls.cache.set(order_id, data, generation)
+        return data
+
     @classmethod
     def find_by_product(cls, product):
         """ Returns all of the Orders linked to a product
@@ -153,8 +980,6 @@ class Order(db.Model):
             product (int): the product of the Orders you want to match
         """
         cls.logger.info('Processing category query for %s ...', product)
-        cls.logger.info(type(product))
-        cls.logger.info(cls.query.filter(cls.product_id == product))
         return cls.query.filter(cls.product_id == product)
 
 
@@ -171,6 +996,37 @@ class Order(db.Model):
             customer (int): the customer for the Orders you want to match
         """
         cls.logger.info('Processing category query for %s ...', customer)
-        cls.logger.info(type(customer))
-        cls.logger.info(cls.query.filter(cls.customer_id == customer))
         return cls.query.filter(cls.customer_id == customer)
+
+
+# The append-only change log of the Orders (a transactional outbox): every
+# write adds the new state of the Orders it changed in the same transaction,
+# and the services that follow the Orders read it with GET /orders/changes
+# instead of listing every Order. The table is added to an existing schema
+# by migration 5 in service/migrations.py
+order_changes = db.Table(
+    'order_change',
+    db.Column('seq', db.Integer, primary_key=True),
+    db.Column('operation', db.String(6), nullable=False),
+    db.Column('changed_at', db.DateTime, nullable=False),
+    db.Column('order_id', db.Integer, nullable=False),
+    db.Column('uuid', db.String(63)),
+    db.Column('product_id', db.Integer),
+    db.Column('customer_id', db.Integer),
+    db.Column('price', db.Integer),
+    db.Column('quantity', db.Integer),
+    db.Column('status', db.String(20)),
+    db.Column('version', db.Integer),
+    # never reuse the seq of a change, or a reader could miss it
+    sqlite_autoincrement=True
+)
+
+# The one row that every transaction updates before it writes the change log,
+# see Order.log_statements. It is added to an existing schema by migration 7
+order_change_lock = db.Table(
+    'order_change_lock',
+    db.Column('id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('written_at', db.DateTime)
+)
+event.listen(order_change_lock, 'after_create',
+             DDL('INSERT INTO order_change_lock (id) VALUES (1)'))
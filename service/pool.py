@@ -0,0 +1,170 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Database Connection Pool
+
+Builds the SQLAlchemy engine options of the application from its
+configuration and counts what happens in the pool, so that pool
+exhaustion shows up in GET /stats/pool instead of as slow requests.
+
+Every worker process has its own pool. Unless DB_POOL_SIZE is set, a pool
+holds one connection per thread of the worker (WORKER_THREADS) and may
+open as many again as overflow. When DB_MAX_CONNECTIONS is set, the
+connections the database allows the service are shared between the
+WEB_CONCURRENCY workers and no pool is sized beyond its share.
+
+SQLite files are not pooled (SQLAlchemy opens a connection per use), so
+no pool options are set for them.
+"""
+import time
+import threading
+from collections import deque
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# the number of seconds checkouts_per_second is averaged over
+RATE_WINDOW = 60
+
+class PoolStats(object):
+    """ Counts the checkouts of a pool and the time they took """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._seconds = deque()
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait):
+        """ Counts a checkout that waited wait seconds for its connection """
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            second = int(self.clock())
+            if self._seconds and self._seconds[-1][0] == second:
+                self._seconds[-1][1] += 1
+            else:
+                self._seconds.append([second, 1])
+            self._expire(second)
+
+    def record_timeout(self, wait):
+        """ Counts a checkout that gave up after wait seconds """
+        with self._lock:
+            self.timeouts += 1
+            self.wait_max = max(self.wait_max, wait)
+
+    def rate(self):
+        """ Returns the checkouts per second over the last RATE_WINDOW seconds """
+        with self._lock:
+            self._expire(int(self.clock()))
+            return sum(count for _, count in self._seconds) / RATE_WINDOW
+
+    def _expire(self, second):
+        """ Forgets the checkouts that are older than the window """
+        while self._seconds and self._seconds[0][0] <= second - RATE_WINDOW:
+            self._seconds.popleft()
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that times every checkout
+
+    The time of a checkout is the time to get a connection: waiting for
+    one to be returned to the pool, or opening a new one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except PoolTimeoutError:
+            self.stats.record_timeout(time.monotonic() - start)
+            raise
+        self.stats.record_checkout(time.monotonic() - start)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() replaces the pool, keep counting where it left off
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+def engine_options(config):
+    """
+    Returns the SQLALCHEMY_ENGINE_OPTIONS for an application configuration
+
+    Args:
+        config (dict): SQLALCHEMY_DATABASE_URI and the optional DB_POOL_SIZE,
+            DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds), DB_POOL_RECYCLE
+            (seconds), DB_POOL_PRE_PING, DB_MAX_CONNECTIONS, WEB_CONCURRENCY
+            and WORKER_THREADS
+    """
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return {}
+    threads = config.get('WORKER_THREADS') or 1
+    pool_size = config.get('DB_POOL_SIZE') or threads
+    max_overflow = config.get('DB_MAX_OVERFLOW')
+    if max_overflow is None:
+        max_overflow = threads
+    if config.get('DB_MAX_CONNECTIONS'):
+        share = max(1, config['DB_MAX_CONNECTIONS'] // (config.get('WEB_CONCURRENCY') or 1))
+        pool_size = min(pool_size, share)
+        max_overflow = min(max_overflow, share - pool_size)
+    return {'poolclass': InstrumentedQueuePool,
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', 3600),
+            'pool_pre_ping': config.get('DB_POOL_PRE_PING', False)}
+
+def pool_stats(pool):
+    """ Returns the state and the counters of a pool as a dictionary """
+    stats = getattr(pool, 'stats', None)
+    if stats is None:
+        return {"pool": type(pool).__name__, "status": pool.status()}
+    checkouts = stats.checkouts
+    return {"pool": type(pool).__name__,
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,     # pylint: disable=protected-access
+            "timeout": pool._timeout,               # pylint: disable=protected-access
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(0, pool.overflow()),
+            "checkouts": checkouts,
+            "checkouts_per_second": round(stats.rate(), 3),
+            "timeouts": stats.timeouts,
+            "wait_ms_average": round(1000 * stats.wait_total / checkouts, 3) if checkouts else 0,
+            "wait_ms_max": round(1000 * stats.wait_max, 3)
+           }
+
+def async_pool_stats(pool):
+    """ Returns the state of the pool of an async driver (asyncpg or aiomysql) as a dictionary """
+    stats = {"pool": type(pool).__name__}
+    if hasattr(pool, 'get_size'):
+        # asyncpg
+        size, idle = pool.get_size(), pool.get_idle_size()
+        stats.update(min_size=pool.get_min_size(), max_size=pool.get_max_size(),
+                     size=size, checked_in=idle, checked_out=size - idle)
+    elif hasattr(pool, 'freesize'):
+        # aiomysql
+        stats.update(min_size=pool.minsize, max_size=pool.maxsize, size=pool.size,
+                     checked_in=pool.freesize, checked_out=pool.size - pool.freesize)
+    return stats
@@ -0,0 +1,183 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read Replicas
+
+DATABASE_REPLICA_URIS lists read-only copies of the database, separated by
+commas. They become the SQLALCHEMY_BINDS replica_0, replica_1, ... and a
+statement goes to one of them only when:
+  - the Resource method that handles the request is decorated with read_only,
+  - the statement is a SELECT, and
+  - the session of the request has not written anything yet,
+so that every write, and every read that follows a write in the same
+request, goes to the primary DATABASE_URI. Each read-only request takes the
+next healthy replica in turn and reads all it needs from that one.
+
+A thread of each worker runs SELECT 1 on every replica every
+REPLICA_CHECK_SECONDS. A replica that fails it, or that fails a statement
+of a request, gets no reads until it passes the check again, and with no
+healthy replica the reads go to the primary. A replica lags behind the
+primary, so a client reads its own writes in a later request only once they
+have been replicated.
+"""
+import os
+import time
+import logging
+import itertools
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, select, literal_column
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from sqlalchemy.sql.expression import SelectBase, UpdateBase
+from service.metrics import handler_of
+from service.threads import PerProcessThread
+
+logger = logging.getLogger('flask.app')
+
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 10))
+# the prefix of the SQLALCHEMY_BINDS of the replicas
+REPLICA_PREFIX = 'replica_'
+
+def read_only(function):
+    """ Decorates a Resource method whose reads may go to a replica """
+    function.read_only = True
+    return function
+
+def replica_binds(uris):
+    """ Returns the SQLALCHEMY_BINDS of a list of replica URIs """
+    return {REPLICA_PREFIX + str(index): uri for index, uri in enumerate(uris)}
+
+class ReplicaRouter(PerProcessThread):
+    """ Chooses the replica of each read-only request and checks their health """
+
+    name = 'replica-check'
+
+    def __init__(self, interval=REPLICA_CHECK_SECONDS):
+        super(ReplicaRouter, self).__init__()
+        self.app = None
+        self.db = None
+        self.interval = interval
+        self.down = set()
+        self.turns = itertools.count()
+
+    def init_app(self, app, db):
+        """ Routes the reads of a Flask app to the replicas in DATABASE_REPLICA_URIS """
+        self.app = app
+        self.db = db
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.update(replica_binds(app.config.get('DATABASE_REPLICA_URIS') or []))
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.before_request(self.start_request)
+
+    def names(self):
+        """ Returns the binds of the replicas """
+        if self.app is None:
+            return []
+        return sorted(name for name in self.app.config.get('SQLALCHEMY_BINDS') or {}
+                      if name.startswith(REPLICA_PREFIX))
+
+    def engine(self, name):
+        """ Returns the engine of a replica """
+        return self.db.get_engine(self.app, bind=name)
+
+    def start_request(self):
+        """ Lets the reads of a read-only request go to a replica """
+        if not self.names():
+            return
+        # the session outlives the request when the app context does
+        info = self.db.session().info
+        info.pop('wrote', None)
+        info.pop('replica', None)
+        info['read_only'] = getattr(handler_of(), 'read_only', False)
+        if info['read_only']:
+            self.start()
+
+    def choose(self):
+        """ Returns the engine of the next healthy replica, or None when there is none """
+        with self.lock:
+            names = [name for name in self.names() if name not in self.down]
+            if not names:
+                return None
+            name = names[next(self.turns) % len(names)]
+        return self.engine(name)
+
+    def mark(self, name, healthy, error=None):
+        """ Records whether a replica can be read from """
+        with self.lock:
+            if healthy and name in self.down:
+                self.down.discard(name)
+                logger.info('Replica %s is back', name)
+            elif not healthy and name not in self.down:
+                self.down.add(name)
+                logger.warning('Replica %s is down: %s', name, error)
+
+    def failed(self, engine, error):
+        """ Marks down the replica of an engine whose statement failed """
+        for name in self.names():
+            if self.engine(name) is engine:
+                self.mark(name, False, error)
+
+    def check(self):
+        """ Runs SELECT 1 on every replica and records which ones answered """
+        for name in self.names():
+            try:
+                with self.engine(name).connect() as connection:
+                    connection.execute(select([literal_column('1')]))
+            except SQLAlchemyError as error:
+                self.mark(name, False, error)
+            else:
+                self.mark(name, True)
+
+    def run(self):
+        """ Checks the replicas every interval seconds """
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:   # pylint: disable=broad-except
+                logger.exception('Could not check the replicas')
+
+# the replica router of this process
+router = ReplicaRouter()
+
+def init_app(app, db):
+    """ Routes the reads of a Flask app to its replicas """
+    router.init_app(app, db)
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    """ Stops reading from a replica that cannot run a statement """
+    if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+        router.failed(context.engine, context.original_exception)
+
+class RoutingSession(SignallingSession):
+    """ A session that reads from a replica while its read-only request has not written """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif self.info.get('read_only') and not self.info.get('wrote') \
+                and isinstance(clause, SelectBase):
+            if 'replica' not in self.info:
+                self.info['replica'] = router.choose()
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that route the reads to the replicas """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
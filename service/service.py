@@ -17,28 +17,56 @@ Order Service
 
 Paths:
 ------
-GET /orders - Returns a list all of the Orders
+GET /orders - Returns a page of the Orders (?limit=&cursor=&sort=), filtered by
+               customer_id, product_id, status and min/max price and quantity
+GET /orders?stream=1 - Streams every Order as NDJSON (or Accept: application/x-ndjson)
 GET /orders/{id} - Returns the Order with a given id number
 POST /orders - creates a new order record in the database
+POST /orders/bulk - creates many order records in a single transaction
+PUT /orders/bulk/cancel - cancels the orders selected by ids or by a filter
+PUT /orders/bulk/deliver - delivers the orders selected by ids or by a filter
+GET /orders/changes - Returns the changes to the Orders after a sequence number
+               (?since=&limit=&wait=), waiting up to wait seconds for one
+GET /orders/events - Streams the changes as Server-Sent Events, filtered by
+               order_id, customer_id or product_id
 PUT /orders/{id} - updates an order record in the database
 DELETE /orders/{id} - deletes an order record in the database
-GET /orders/customers/:customer_id - return orders for given customer
-GET /orders/products/:product_id - return orders for given product
+GET /orders/customers/:customer_id - return a page of orders for given customer
+GET /orders/products/:product_id - return a page of orders for given product
+GET /orders/customers/:customer_id/summary - return order counts and totals for a customer
+GET /orders/products/:product_id/summary - return order counts and totals for a product
 PUT /orders/cancel/:id - cancel an order for a given order id
+GET /health/live - returns 200 while the process is up
+GET /health/ready - returns 200 when the database can be reached, 503 otherwise
+GET /metrics - returns the request and database metrics for Prometheus
 """
 
+import json
+import base64
+import hashlib
+import binascii
 import logging
 from functools import wraps
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, \
+    stream_with_context
 from flask_api import status    # HTTP Status Codes
 from flask_restplus import Api as BaseApi, Resource, fields, reqparse, inputs
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, BadRequest, Conflict, PreconditionFailed
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 # from service.models import order, DataValidationError
-from service.models import Order, DataValidationError
+from service.models import Order, DataValidationError, TransitionError, VersionConflictError, \
+    db, MAX_INTEGER, MAX_PAGE_SIZE, PAGE_SIZE, MAX_BULK_SIZE, TRANSITIONS, STATUSES, SORT_KEYS, \
+    MAX_CHANGES_WAIT
+from service.migrations import upgrade
+from service.encoding import encode_rows, encode_ndjson
+from service.pool import pool_stats
+from service import metrics, events, group_commit
+from service.metrics import query_budget
+from service.replicas import read_only
 
 # Import Flask application
 from . import app
@@ -78,21 +106,70 @@ order_model = api.model('Order', {
     'quantity': fields.Integer(required=True, description='The quantity of the product in the Order'),
     'customer_id': fields.Integer(required=True, description='The unique id of the customer who places the Order'),
     'product_id': fields.Integer(required=True, description='The unique id of the product in the Order'),
-    'status': fields.String(required=True, description='The status of the Order(In Progress, Delivered, Cancelled)')
+    'status': fields.String(required=True, description='The status of the Order(In Progress, Delivered, Cancelled)'),
+    'version': fields.Integer(readOnly=True, description='Incremented by every change, used as the ETag')
 })
 
 # query string arguments
 order_args = reqparse.RequestParser()
-order_args.add_argument('customer_id', type=int, required=False, help='List Orders by customer id')
-order_args.add_argument('product_id', type=int, required=False, help='List Orders by product id')
+order_args.add_argument('customer_id', type=int, required=False, location='args',
+                        help='List Orders by customer id')
+order_args.add_argument('product_id', type=int, required=False, location='args',
+                        help='List Orders by product id')
+order_args.add_argument('status', type=str, required=False, location='args', choices=STATUSES,
+                        help='List Orders by status')
+order_args.add_argument('min_price', type=int, required=False, location='args',
+                        help='List Orders with at least this unit price')
+order_args.add_argument('max_price', type=int, required=False, location='args',
+                        help='List Orders with at most this unit price')
+order_args.add_argument('min_quantity', type=int, required=False, location='args',
+                        help='List Orders with at least this quantity')
+order_args.add_argument('max_quantity', type=int, required=False, location='args',
+                        help='List Orders with at most this quantity')
+
+# paging arguments shared by every list endpoint
+page_args = reqparse.RequestParser()
+page_args.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), location='args',
+                       default=PAGE_SIZE, help='Maximum number of Orders in the page')
+page_args.add_argument('cursor', type=str, location='args',
+                       help='Opaque cursor taken from the previous page')
+page_args.add_argument('stream', type=inputs.boolean, location='args', default=False,
+                       help='Stream every matching Order as newline delimited JSON')
+page_args.add_argument('sort', type=str, location='args', default='id',
+                       choices=SORT_KEYS + tuple('-' + key for key in SORT_KEYS),
+                       help='Sort by id, price or quantity, prefix with - for descending')
+
+# change log arguments
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=inputs.int_range(0, MAX_INTEGER), location='args',
+                          default=0, help='Return the changes after this sequence number')
+changes_args.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), location='args',
+                          default=PAGE_SIZE, help='Maximum number of changes')
+changes_args.add_argument('wait', type=inputs.int_range(0, MAX_CHANGES_WAIT), location='args',
+                          default=0, help='Seconds to wait for a change when there is none')
+
+# event stream arguments
+events_args = reqparse.RequestParser()
+events_args.add_argument('order_id', type=int, location='args',
+                         help='Only the changes of this Order')
+events_args.add_argument('customer_id', type=int, location='args',
+                         help='Only the changes of the Orders of this customer')
+events_args.add_argument('product_id', type=int, location='args',
+                         help='Only the changes of the Orders of this product')
+
+NDJSON = 'application/x-ndjson'
 
 ######################################################################
 # Error Handlers
 ######################################################################
-# @app.errorhandler(DataValidationError)
-# def request_validation_error(error):
-#     """ Handles Value Errors from bad data """
-#     return bad_request(error)
+@api.errorhandler(DataValidationError)
+def request_validation_error(error):
+    """ Handles Value Errors from bad data """
+    message = str(error)
+    app.logger.warning(message)
+    return {'status': status.HTTP_400_BAD_REQUEST,
+            'error': 'Bad Request',
+            'message': message}, status.HTTP_400_BAD_REQUEST
 
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
@@ -142,6 +219,9 @@ class OrderResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_order')
     @api.response(404, 'Order not found')
+    @api.response(304, 'The Order still matches the ETag in If-None-Match')
+    @read_only
+    @query_budget(1)
     def get(self, order_id):
         """
         Retrieve a single Order
@@ -150,12 +230,16 @@ class OrderResource(Resource):
         :return:
         """
         app.logger.info('Request for an order with id: %s', order_id)
-        order = Order.find(order_id)
-        # print(order.id)
-
+        order = Order.find_serialized(order_id)
         if not order:
             raise NotFound("Order with id '{}' was not found.".format(order_id))
-        return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+        # the version is the ETag, a 304 is answered before any encoding
+        etag = str(order['version'])
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        response = make_response(jsonify(order), status.HTTP_200_OK)
+        response.set_etag(etag)
+        return response
     
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -163,26 +247,43 @@ class OrderResource(Resource):
     @api.doc('Update_order')
     @api.response(404, 'Order not found')
     @api.response(400, 'The posted order data was not valid')
+    @api.response(409, 'The Order is no longer at the version in the body')
+    @api.response(412, 'The Order no longer matches the ETag in If-Match')
+    @query_budget(4)
     def put(self, order_id):
         """
         Update an Order
-        This endpoint will update an Order based the body that is posted
+        This endpoint will update an Order based the body that is posted.
+        When the body has a version (or the request an If-Match header) the
+        Order is only updated if it is still at that version
         """
         app.logger.info('Request to update order with id: %s', order_id)
         check_content_type('application/json')
-        order = Order.find(order_id)
+        data = request.get_json()
+        versions = if_match_versions()
+        try:
+            expected = versions
+            if expected is None and Order.version_of(data) is not None:
+                expected = [Order.version_of(data)]
+            order = Order.replace(order_id, data, expected)
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        except VersionConflictError as error:
+            if versions is not None:
+                raise PreconditionFailed(str(error))
+            raise Conflict(str(error))
         if not order:
             raise NotFound("Order with id '{}' was not found.".format(order_id))
-        order.deserialize(request.get_json())
-        order.id = order_id
-        order.save()
-        return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+        response = make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+        response.set_etag(str(order.version))
+        return response
     
     # ------------------------------------------------------------------
     # DELETE AN ORDER
     # ------------------------------------------------------------------
     @api.doc('delete_orders')
     @api.response(204, 'Order deleted')
+    @query_budget(4)
     def delete(self, order_id):
         """
         Delete an Order
@@ -204,14 +305,15 @@ class OrderCollection(Resource):
     # LIST ALL ORDERS
     ######################################################################
     @api.doc('list_orders')
+    @api.expect(order_args, page_args, validate=True)
     # @api.marshal_list_with(order_model)
+    @read_only
+    @query_budget(1)
     def get(self):
-        """ Returns all of the Orders """
+        """ Returns a page of the Orders that match the query string """
         app.logger.info('Request for order list')
-        orders = Order.all()
-
-        results = [order.serialize() for order in orders]
-        return make_response(jsonify(results), status.HTTP_200_OK)
+        args = order_args.parse_args()
+        return paginated_response(Order.search(**args))
     
     ######################################################################
     # ADD A NEW ORDER
@@ -219,21 +321,186 @@ class OrderCollection(Resource):
     @api.doc('create_oders')
     @api.expect(order_model)
     @api.response(400, 'The posted data was not valid')
-    @api.response(201, 'Order created successfully')
-    @api.marshal_with(order_model, code=201)
+    @api.response(201, 'Order created successfully', order_model)
+    @api.response(200, 'An Order with the same uuid already exists and is returned',
+                  order_model)
+    @api.response(503, 'The Order was not committed in time, post it again')
+    @query_budget(3)
     def post(self):
         """
         Creates an Order
-        This endpoint will create an Order based the data in the body that is posted
+        This endpoint will create an Order based the data in the body that is posted.
+        Posting an Order with the uuid of an existing one returns the existing Order
         """
         app.logger.info('Request to create an order')
         check_content_type('application/json')
-        order = Order()
-        order.deserialize(request.get_json())
-        order.save()
-        message = order.serialize()
-        location_url = api.url_for(OrderCollection, order_id=order.id, _external=True)
-        return order.serialize(), status.HTTP_201_CREATED, {'Location': location_url }
+        if app.config['GROUP_COMMIT']:
+            try:
+                order, created = group_commit.committer.create(request.get_json())
+            except group_commit.GroupCommitTimeout as error:
+                app.logger.warning(str(error))
+                # the uuid makes posting it again safe, even if it was committed since
+                response = make_response(jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                                 error='Service Unavailable',
+                                                 message=str(error)),
+                                         status.HTTP_503_SERVICE_UNAVAILABLE)
+                response.headers['Retry-After'] = 1
+                return response
+        else:
+            order, created = Order.create_or_get(request.get_json())
+        code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        response = make_response(jsonify(order.serialize()), code)
+        response.headers['Location'] = api.url_for(OrderResource, order_id=order.id,
+                                                   _external=True)
+        return response
+
+######################################################################
+#  PATH: /orders/bulk
+######################################################################
+@api.route('/orders/bulk')
+class OrderBulkResource(Resource):
+    """ Creates many Orders with one request and one transaction """
+    @api.doc('bulk_create_orders')
+    @api.expect([order_model])
+    @api.response(400, 'The posted data was not a list of orders')
+    @api.response(201, 'All Orders created successfully')
+    @api.response(207, 'Some Orders were not valid or already existed')
+    @query_budget(5)
+    def post(self):
+        """
+        Creates many Orders
+        This endpoint creates every valid Order in the posted list and returns
+        a result for each one, in the order they were posted. Orders whose
+        uuid already exists are returned with code 200 instead of created
+        """
+        app.logger.info('Request to bulk create orders')
+        check_content_type('application/json')
+        items = request.get_json()
+        if not isinstance(items, list):
+            raise BadRequest('The body must be a list of orders')
+        if len(items) > MAX_BULK_SIZE:
+            raise BadRequest('At most {} orders can be created at once'.format(MAX_BULK_SIZE))
+        results = []
+        for result in Order.bulk_create(items):
+            if isinstance(result, DataValidationError):
+                results.append({'code': status.HTTP_400_BAD_REQUEST, 'message': str(result)})
+            else:
+                order, created = result
+                code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+                results.append({'code': code, 'order': order.serialize()})
+        created = sum(1 for result in results if result['code'] == status.HTTP_201_CREATED)
+        existing = sum(1 for result in results if result['code'] == status.HTTP_200_OK)
+        failed = len(results) - created - existing
+        code = status.HTTP_201_CREATED if created == len(results) else status.HTTP_207_MULTI_STATUS
+        return make_response(jsonify(created=created,
+                                     existing=existing,
+                                     failed=failed,
+                                     results=results), code)
+
+######################################################################
+#  PATH: /orders/bulk/{action}
+######################################################################
+# the bulk actions with the status they move the Orders to
+BULK_ACTIONS = {'cancel': 'Cancelled', 'deliver': 'Delivered'}
+
+bulk_transition_model = api.model('BulkTransition', {
+    'ids': fields.List(fields.Integer, description='The ids of the Orders to change'),
+    'customer_id': fields.Integer(description='Change the Orders of this customer'),
+    'product_id': fields.Integer(description='Change the Orders of this product'),
+    'status': fields.String(description='Only change the Orders with this current status')
+})
+
+@api.route('/orders/bulk/<string:action>')
+@api.param('action', 'The transition to apply (cancel or deliver)')
+class OrderBulkTransitionResource(Resource):
+    """ Changes the status of many Orders with one UPDATE """
+    @api.doc('bulk_transition_orders')
+    @api.expect(bulk_transition_model)
+    @api.response(404, 'Unknown action')
+    @api.response(400, 'The posted selection was not valid')
+    @query_budget(4)
+    def put(self, action):
+        """
+        Cancel or deliver many Orders
+        This endpoint changes every Order selected by ids or by customer_id,
+        product_id and current status that can make the transition
+        """
+        app.logger.info('Request to bulk %s orders', action)
+        if action not in BULK_ACTIONS:
+            raise NotFound("Bulk action '{}' was not found.".format(action))
+        check_content_type('application/json')
+        new_status = BULK_ACTIONS[action]
+        selection = bulk_selection(new_status, request.get_json())
+        try:
+            changed = Order.bulk_transition(new_status, **selection)
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        return make_response(jsonify(count=len(changed), ids=changed), status.HTTP_200_OK)
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+@api.route('/orders/changes')
+class OrderChangesResource(Resource):
+    """ The change log of the Orders, for the services that follow them """
+
+    @api.doc('list_order_changes')
+    @api.expect(changes_args, validate=True)
+    # no query budget: a long poll reads the log until a change arrives
+    def get(self):
+        """
+        Returns the changes to the Orders after a sequence number
+        Every create, update and delete of an Order is logged with the new
+        state of the Order. Pass the next value of the response as since to
+        get the following changes; with wait the request is held until there
+        is a change, for at most wait seconds, unless the worker already
+        holds as many requests as MAX_EVENT_STREAMS
+        """
+        args = changes_args.parse_args()
+        rows, last = events.wait_for_changes(args['since'], args['limit'], args['wait'],
+                                             app.config['MAX_EVENT_STREAMS'])
+        return make_response(jsonify(changes=[Order.serialize_change(row) for row in rows],
+                                     next=last), status.HTTP_200_OK)
+
+######################################################################
+#  PATH: /orders/events
+######################################################################
+@api.route('/orders/events')
+class OrderEventsResource(Resource):
+    """ Pushes the changes of the Orders to browsers as they happen """
+
+    @api.doc('stream_order_events')
+    @api.expect(events_args, validate=True)
+    @api.response(503, 'This worker streams as many events as it may')
+    # no query budget: the stream lasts for minutes
+    def get(self):
+        """
+        Streams the changes to the Orders as Server-Sent Events
+        Every create, update and delete of an Order that matches the filters
+        is sent as an event with the id of the change and the new state of
+        the Order. A client that reconnects with Last-Event-ID first gets the
+        changes it missed
+        """
+        args = events_args.parse_args()
+        subscription = events.Subscription(**args)
+        try:
+            events.publisher.subscribe(subscription, app.config['MAX_EVENT_STREAMS'])
+        except events.TooManySubscribers as error:
+            app.logger.warning('Refusing an event stream: %s', error)
+            response = make_response(jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                             error='Service Unavailable',
+                                             message=str(error)),
+                                     status.HTTP_503_SERVICE_UNAVAILABLE)
+            response.headers['Retry-After'] = int(events.EVENT_RETRY_MS / 1000)
+            return response
+        since = events.last_event_id(request.headers.get('Last-Event-ID'))
+        response = Response(stream_with_context(events.stream(subscription, since)),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache',
+                                     'X-Accel-Buffering': 'no'})
+        # also when the client goes away before the stream starts
+        response.call_on_close(lambda: events.publisher.unsubscribe(subscription))
+        return response
 
 ######################################################################
 # CANCEL AN ORDER
@@ -246,21 +513,27 @@ class OrderCancelResource(Resource):
     """
     @api.doc('Cancel_order')
     @api.response(404, 'Order not cancelled')
-    @api.response(400, 'The posted order data was not valid')
+    @api.response(409, 'The Order is not In Progress and cannot be cancelled')
+    @api.response(412, 'The Order no longer matches the ETag in If-Match')
+    @query_budget(4)
     def put(self, order_id):
         """
         Cancel an Order
-        This endpoint will cancel an Order based the id specified in the path
+        This endpoint will cancel an Order based the id specified in the path.
+        No body is needed and only an Order that is In Progress can be cancelled
         """
         app.logger.info('Request to cancel an order with id: %s', order_id)
-        check_content_type('application/json')
-        order = Order.find(order_id)
+        try:
+            order = Order.cancel(order_id, if_match_versions())
+        except VersionConflictError as error:
+            raise PreconditionFailed(str(error))
+        except TransitionError as error:
+            raise Conflict(str(error))
         if not order:
             raise NotFound("Order with id '{}' was not found.".format(order_id))
-        order.deserialize(request.get_json())
-        order.status = 'Cancelled'
-        order.save()
-        return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+        response = make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+        response.set_etag(str(order.version))
+        return response
 
 ######################################################################
 # LIST ORDERS BASED ON PRODUCT ID
@@ -272,17 +545,15 @@ class OrderProductListResource(Resource):
     Contains resource for listing orders on product id
     """
     @api.doc('List_by_product_id')
+    @api.expect(page_args, validate=True)
     @api.response(404, 'Product ID not found')
     @api.response(400, 'Posted json is not valid')
+    @read_only
+    @query_budget(1)
     def get(self, product_id):
-        """ Returns all of the Orders """
+        """ Returns a page of the Orders for a product """
         app.logger.info('Request for order list')
-        orders = []
-        if product_id:
-            orders = Order.find_by_product(product_id)
-
-        results = [order.serialize() for order in orders]
-        return make_response(jsonify(results), status.HTTP_200_OK)
+        return paginated_response(Order.find_by_product(product_id))
 
 ######################################################################
 # RETRIEVE AN ORDER BASED ON CUSTOMER ID
@@ -294,21 +565,73 @@ class OrderRetreivalCustomerResource(Resource):
     Contains resouce for fetching via customer ID
     """
     @api.doc('Fetch_via_customer')
+    @api.expect(page_args, validate=True)
     @api.response(404, 'Customer ID not found')
     @api.response(400, 'JSON body is invalid')
+    @read_only
+    @query_budget(1)
     def get(self, customer_id):
         """
         Retrieve an order
-        This endpoint will return an order based on it's customer id
+        This endpoint will return a page of orders based on it's customer id
         """
-        print(customer_id)
         app.logger.info('Request for order list based on customer id: %s', customer_id)
-        orders = Order.find_by_customer(customer_id)
-        if not orders:
-            raise NotFound("Order with customer id '{}' was not found.".format(customer_id))
-        else:
-            results = [order.serialize() for order in orders]
-            return make_response(jsonify(results), status.HTTP_200_OK)
+        return paginated_response(Order.find_by_customer(customer_id))
+
+######################################################################
+# SUMMARIZE ORDERS BASED ON CUSTOMER OR PRODUCT ID
+######################################################################
+totals_model = api.model('OrderTotals', {
+    'count': fields.Integer(description='The number of Orders'),
+    'total_quantity': fields.Integer(description='The sum of the quantities'),
+    'total_value': fields.Integer(description='The sum of price * quantity')
+})
+
+summary_model = api.inherit('OrderSummary', totals_model, {
+    'by_status': fields.Raw(description='The totals for each status')
+})
+
+@api.route('/orders/customers/<int:customer_id>/summary')
+@api.param('customer_id', 'The customer identifier')
+class OrderCustomerSummaryResource(Resource):
+    """
+    Contains resource for the order totals of a customer
+    """
+    @api.doc('Summarize_via_customer')
+    @api.response(200, 'The totals of the customer', summary_model)
+    @read_only
+    @query_budget(1)
+    def get(self, customer_id):
+        """
+        Summarize the Orders of a customer
+        This endpoint returns the count, quantity and value of the Orders of
+        a customer, overall and by status, computed in the database
+        """
+        app.logger.info('Request for order summary of customer: %s', customer_id)
+        summary = Order.summarize(Order.find_by_customer(customer_id))
+        summary['customer_id'] = customer_id
+        return make_response(jsonify(summary), status.HTTP_200_OK)
+
+@api.route('/orders/products/<int:product_id>/summary')
+@api.param('product_id', 'The product identifier')
+class OrderProductSummaryResource(Resource):
+    """
+    Contains resource for the order totals of a product
+    """
+    @api.doc('Summarize_by_product_id')
+    @api.response(200, 'The totals of the product', summary_model)
+    @read_only
+    @query_budget(1)
+    def get(self, product_id):
+        """
+        Summarize the Orders of a product
+        This endpoint returns the count, quantity and value of the Orders of
+        a product, overall and by status, computed in the database
+        """
+        app.logger.info('Request for order summary of product: %s', product_id)
+        summary = Order.summarize(Order.find_by_product(product_id))
+        summary['product_id'] = product_id
+        return make_response(jsonify(summary), status.HTTP_200_OK)
 
 ######################################################################
 # DELETE ALL PET DATA (for testing only)
@@ -319,14 +642,187 @@ def orders_reset():
     Order.remove_all()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# CACHE STATISTICS
+######################################################################
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    """ Returns the counters of the order cache for tuning """
+    return make_response(jsonify(Order.cache.stats()), status.HTTP_200_OK)
+
+######################################################################
+# HEALTH CHECKS
+######################################################################
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    """ Returns 200 while the process can answer requests """
+    return make_response(jsonify(status='OK'), status.HTTP_200_OK)
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    """ Returns 200 when the database can be reached and 503 when it cannot """
+    try:
+        db.session.execute(db.select([db.literal_column('1')]))
+    except SQLAlchemyError as error:
+        app.logger.warning('Database is not reachable: %s', error)
+        return make_response(jsonify(status='Service Unavailable', database=str(error)),
+                             status.HTTP_503_SERVICE_UNAVAILABLE)
+    return make_response(jsonify(status='OK', database='OK'), status.HTTP_200_OK)
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """ Returns the metrics of the service in the Prometheus text format """
+    data, content_type = metrics.expose()
+    return Response(data, status=status.HTTP_200_OK, headers={'Content-Type': content_type})
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/stats/pool', methods=['GET'])
+def connection_pool_stats():
+    """ Returns the state and counters of the database connection pool """
+    return make_response(jsonify(pool_stats(db.engine.pool)), status.HTTP_200_OK)
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 def init_db():
-    """ Initialies the SQLAlchemy app """
+    """ Initialies the SQLAlchemy app and brings the schema up to date """
     global app
     Order.init_db(app)
+    upgrade(db.engine)
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """ Creates the tables and applies the schema migrations """
+    init_db()
+
+def paginated_response(query):
+    """ Returns one page of the query as a JSON list
+
+    The rows are read and encoded without building Order instances.
+    The next page is advertised with a Link header (rel="next") and the
+    X-Next-Cursor header, both of which are omitted on the last page. The
+    page is not serialized when it still matches the ETag in If-None-Match.
+    Clients that ask for ?stream=1 or Accept: application/x-ndjson get a
+    stream of every matching Order instead.
+    """
+    args = page_args.parse_args()
+    sort = args['sort'].lstrip('-')
+    descending = args['sort'].startswith('-')
+    after = decode_cursor(args['cursor'], sort)
+    if args['stream'] or \
+            request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON:
+        return streamed_response(query, after, sort, descending)
+    rows, after = Order.paginate_rows(query, after, args['limit'], sort, descending)
+    etag = collection_etag((row.id, row.version) for row in rows)
+    if request.if_none_match.contains_weak(etag):
+        response = not_modified(etag)
+    else:
+        response = Response(encode_rows(Order.column_names(), rows),
+                            status=status.HTTP_200_OK, mimetype='application/json')
+        response.set_etag(etag)
+    if after is not None:
+        cursor = encode_cursor(after)
+        params = dict(request.view_args, **request.args.to_dict())
+        params.update(cursor=cursor, limit=args['limit'])
+        next_url = url_for(request.endpoint, _external=True, **params)
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        response.headers['X-Next-Cursor'] = cursor
+    return response
+
+def streamed_response(query, after=None, sort='id', descending=False):
+    """ Streams every Order of the query as newline delimited JSON
+
+    Orders are read and written one batch at a time, so memory use and the
+    time to the first byte stay the same however many Orders there are.
+    """
+    keys = Order.column_names()
+    def generate():
+        for rows in Order.iterate(query, after, sort=sort, descending=descending):
+            yield encode_ndjson(keys, rows)
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK,
+                    mimetype=NDJSON)
+
+def bulk_selection(new_status, data):
+    """ Returns the bulk_transition arguments of a request body or raises BadRequest """
+    if not isinstance(data, dict):
+        raise BadRequest('The body must be an object')
+    ids = data.get('ids')
+    if ids is not None and (not isinstance(ids, list) or len(ids) > MAX_BULK_SIZE or
+                            not all(map(is_integer, ids))):
+        raise BadRequest('ids must be a list of at most {} integers'.format(MAX_BULK_SIZE))
+    for name in ('customer_id', 'product_id'):
+        if data.get(name) is not None and not is_integer(data[name]):
+            raise BadRequest('{} must be an integer, not {!r}'.format(name, data[name]))
+    if data.get('status') not in (None,) + TRANSITIONS[new_status]:
+        raise BadRequest("Orders with status '{}' cannot be {}".format(data['status'],
+                                                                        new_status))
+    return {'ids': ids,
+            'customer_id': data.get('customer_id'),
+            'product_id': data.get('product_id'),
+            'status': data.get('status')}
+
+def collection_etag(versions):
+    """ Returns the ETag of a list of Orders from their (id, version) pairs """
+    digest = hashlib.sha1()
+    for order_id, version in versions:
+        digest.update('{}.{};'.format(order_id, version).encode('ascii'))
+    return digest.hexdigest()
+
+def not_modified(etag):
+    """ Returns a 304 Not Modified response for an ETag """
+    response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+def if_match_versions():
+    """ Returns the Order versions listed in If-Match, or None for any version
+
+    Raises BadRequest when a tag is not a version
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    tags = request.if_match.as_set()
+    if not all(tag.isdigit() for tag in tags):
+        raise BadRequest('If-Match must list Order versions, not {}'.format(
+            request.headers.get('If-Match')))
+    return [int(tag) for tag in tags]
+
+def encode_cursor(after):
+    """ Encodes the position of the last row of a page as an opaque cursor """
+    token = base64.urlsafe_b64encode(json.dumps(after).encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort='id'):
+    """ Decodes a cursor made by encode_cursor or raises BadRequest
+
+    The cursor of a page sorted by id is the last id, the cursor of a page
+    sorted by another column is the pair [last value, last id].
+    """
+    if not cursor:
+        return None
+    try:
+        token = cursor.encode('ascii') + b'=' * (-len(cursor) % 4)
+        after = json.loads(base64.urlsafe_b64decode(token).decode('utf-8'))
+    except (ValueError, UnicodeError, binascii.Error):
+        after = None
+    if sort == 'id':
+        valid = is_integer(after)
+    else:
+        valid = isinstance(after, list) and len(after) == 2 and all(map(is_integer, after))
+    if not valid:
+        raise BadRequest("Invalid cursor '{}'".format(cursor))
+    return after
+
+def is_integer(value):
+    """ Returns True for an int that is not a bool and fits an INTEGER column """
+    return isinstance(value, int) and not isinstance(value, bool) \
+        and -MAX_INTEGER - 1 <= value <= MAX_INTEGER
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
@@ -4,8 +4,14 @@ $(function () {
     //  U T I L I T Y   F U N C T I O N S
     // ****************************************
 
+    // The id and version of the order last shown in the form, the version
+    // is sent back in If-Match by an update of that order so that it does
+    // not overwrite a change made since
+    var form_order = null;
+
     // Updates the form with data from the response
     function update_form_data(res) {
+        form_order = {id: String(res.id), version: res.version};
         $("#order_id").val(res.id);
         $("#order_uuid").val(res.uuid);
         $("#order_price").val(res.price);
@@ -21,6 +27,7 @@ $(function () {
 
     /// Clears all form fields
     function clear_form_data() {
+        form_order = null;
         $("#order_uuid").val("");
         $("#order_price").val("");
         $("#order_quantity").val("");
@@ -35,6 +42,73 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // Returns the row of an order in the search results
+    function order_row(order) {
+        return '<tr id="order-row-' + order.id + '"><td>'+order.id+"</td><td>"+order.price+"</td><td>"+order.quantity+"</td><td>"+order.customer_id+"</td><td>"+order.product_id+"</td><td>"+order.status+"</td></tr>";
+    }
+
+    // ****************************************
+    // Live updates with Server-Sent Events
+    // ****************************************
+
+    var events = null;
+    var events_query = null;
+
+    // Listens to the changes of the orders that match a query,
+    // e.g. "order_id=1" or "customer_id=2"
+    function subscribe(query) {
+        if (typeof(EventSource) === "undefined" || query == events_query) {
+            return;
+        }
+        unsubscribe();
+        events_query = query;
+        events = new EventSource("/orders/events?" + query);
+        events.addEventListener("create", show_change);
+        events.addEventListener("update", show_change);
+        events.addEventListener("delete", show_change);
+        events.onerror = function () {
+            // the browser reconnects by itself unless the server refused,
+            // e.g. when it streams too many events already
+            if (events.readyState == EventSource.CLOSED) {
+                setTimeout(function () {
+                    var query = events_query;
+                    events_query = null;
+                    subscribe(query);
+                }, 5000);
+            }
+        };
+    }
+
+    function unsubscribe() {
+        if (events) {
+            events.close();
+        }
+        events = null;
+        events_query = null;
+    }
+
+    // Shows a change to an order in the form and the search results
+    function show_change(event) {
+        var change = JSON.parse(event.data);
+        var order = change.order;
+        var row = $("#order-row-" + order.id);
+        if (change.operation == "delete") {
+            row.remove();
+        } else if (row.length) {
+            row.replaceWith(order_row(order));
+        } else if (change.operation == "create" && $("#search_results tr").length) {
+            $("#search_results tr:last").after(order_row(order));
+        }
+        if ($("#order_id").val() == String(order.id)) {
+            if (change.operation == "delete") {
+                clear_form_data()
+            } else {
+                update_form_data(order)
+            }
+        }
+        flash_message("Order " + order.id + " was " + change.operation + "d")
+    }
+
     //generate an uuid
     function createUUID() {
         return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
@@ -50,10 +124,11 @@ $(function () {
     $("#create-btn").click(function () {
 
         var uuid = $("#order_uuid").val();
-        var price = $("#order_price").val();
-        var quantity = $("#order_quantity").val();
-        var customer_id = $("#order_customer_id").val();
-        var product_id = $("#order_product_id").val();
+        // the service only takes numbers, not the strings of the inputs
+        var price = parseInt($("#order_price").val(), 10);
+        var quantity = parseInt($("#order_quantity").val(), 10);
+        var customer_id = parseInt($("#order_customer_id").val(), 10);
+        var product_id = parseInt($("#order_product_id").val(), 10);
         var status = $("#order_status").val();
 
         var data = {
@@ -74,6 +149,7 @@ $(function () {
 
         ajax.done(function(res){
             update_form_data(res)
+            subscribe("order_id=" + res.id)
             flash_message("Success")
         });
 
@@ -91,10 +167,11 @@ $(function () {
 
         var order_id = $("#order_id").val();
         var uuid = $("#order_uuid").val();
-        var price = $("#order_price").val();
-        var quantity = $("#order_quantity").val();
-        var customer_id = $("#order_customer_id").val();
-        var product_id = $("#order_product_id").val();
+        // the service only takes numbers, not the strings of the inputs
+        var price = parseInt($("#order_price").val(), 10);
+        var quantity = parseInt($("#order_quantity").val(), 10);
+        var customer_id = parseInt($("#order_customer_id").val(), 10);
+        var product_id = parseInt($("#order_product_id").val(), 10);
         var status = $("#order_status").val();
 
         var data = {
@@ -106,15 +183,22 @@ $(function () {
           "status": status
         };
 
+        var headers = {};
+        if (form_order && form_order.id == order_id) {
+            headers["If-Match"] = '"' + form_order.version + '"';
+        }
+
         var ajax = $.ajax({
                 type: "PUT",
                 url: "/orders/" + order_id,
                 contentType: "application/json",
+                headers: headers,
                 data: JSON.stringify(data)
             })
 
         ajax.done(function(res){
             update_form_data(res)
+            subscribe("order_id=" + res.id)
             flash_message("Success")
         });
 
@@ -142,6 +226,7 @@ $(function () {
         ajax.done(function(res){
             //alert(res.toSource())
             update_form_data(res)
+            subscribe("order_id=" + res.id)
             flash_message("Success")
         });
 
@@ -169,6 +254,7 @@ $(function () {
 
         ajax.done(function(res){
             clear_form_data()
+            unsubscribe()
             flash_message("Order has been Deleted!")
         });
 
@@ -237,8 +323,7 @@ $(function () {
             var firstOrder = "";
             for(var i = 0; i < res.length; i++) {
                 var order = res[i];
-                var row = "<tr><td>"+order.id+"</td><td>"+order.price+"</td><td>"+order.quantity+"</td><td>"+order.customer_id+"</td><td>"+order.product_id+"</td><td>"+order.status+"</td></tr>";
-                $("#search_results").append(row);
+                $("#search_results").append(order_row(order));
                 if (i == 0) {
                     firstOrder = order;
                 }
@@ -251,6 +336,15 @@ $(function () {
                 update_form_data(firstOrder)
             }
 
+            // keep the results up to date
+            if (customer_id) {
+                subscribe("customer_id=" + customer_id)
+            } else if (product_id) {
+                subscribe("product_id=" + product_id)
+            } else {
+                subscribe("")
+            }
+
             flash_message("Success")
         });
 
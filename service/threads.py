@@ -0,0 +1,56 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background threads of the worker processes
+
+The application is imported once in the gunicorn master and forked into the
+workers, and a thread does not survive a fork. So a background thread is
+not started on import but by the first request of each process that needs
+it, and started again in a process that forked from the one it runs in.
+"""
+import os
+import threading
+
+class PerProcessThread(object):
+    """ Runs the run method in one daemon thread per process """
+
+    # the name of the thread
+    name = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        """ Starts the thread, unless it already runs in this process """
+        with self.lock:
+            self._start()
+
+    def _start(self):
+        """ Starts the thread like start, for a caller that holds the lock """
+        # a thread does not survive a fork, the worker starts its own
+        if self.thread is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.before_start()
+            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def before_start(self):
+        """ Resets the state the thread shares with the callers, before it starts """
+
+    def run(self):
+        """ The body of the thread """
+        raise NotImplementedError
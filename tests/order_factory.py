@@ -11,7 +11,7 @@ class OrderFactory(factory.Factory):
     class Meta:
         model = Order
     id = factory.Sequence(lambda n: n)
-    uuid = str(uuid.uuid4())
+    uuid = factory.LazyFunction(lambda: str(uuid.uuid4()))
     product_id = 2
     customer_id = 1
     price = 20
@@ -0,0 +1,141 @@
+"""
+Test cases for the Order Cache
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from unittest.mock import patch
+from service.cache import LocalCache, SharedCache, MemoryClient, NullCache, create_cache
+
+class FakeClock(object):
+    """ A clock that only moves when told to """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLocalCache(unittest.TestCase):
+    """ Test Cases for the in-process LRU cache """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LocalCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        """ Count hits and misses """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {'id': 1})
+        self.assertEqual(self.cache.get(1), {'id': 1})
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.get(1)
+        self.cache.set(3, 'three')
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), 'one')
+        self.assertEqual(self.cache.get(3), 'three')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expire(self):
+        """ Expire values after the TTL """
+        self.cache.set(1, 'one')
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get(1), 'one')
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_delete_and_clear(self):
+        """ Invalidate one or all values """
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.delete(1)
+        self.cache.delete(5)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_invalidated_while_read(self):
+        """ Do not cache a value read before an invalidation """
+        generation = self.cache.generation()
+        self.cache.delete(1)
+        self.cache.set(1, 'old', generation)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, 'new', self.cache.generation())
+        self.assertEqual(self.cache.get(1), 'new')
+
+class TestSharedCache(unittest.TestCase):
+    """ Test Cases for the shared cache with the in-process client """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = SharedCache(MemoryClient(clock=self.clock), ttl=10)
+
+    def test_round_trip(self):
+        """ Store values as JSON and count hits and misses """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {'id': 1, 'status': 'In Progress'})
+        self.assertEqual(self.cache.get(1), {'id': 1, 'status': 'In Progress'})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_expire_delete_and_clear(self):
+        """ Expire, invalidate and clear values """
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.set(3, 'three')
+        self.cache.delete(1)
+        self.assertIsNone(self.cache.get(1))
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(2))
+        self.clock.now = 0
+        generation = self.cache.generation()
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(3))
+        self.assertEqual(self.cache.generation(), generation + 1)
+
+    def test_invalidated_while_read(self):
+        """ Do not keep a value read before an invalidation, even one that raced the set """
+        generation = self.cache.generation()
+        self.cache.delete(1)
+        self.cache.set(1, 'old', generation)
+        self.assertIsNone(self.cache.get(1))
+        # the invalidation comes between the check of the generation and the write
+        generation = self.cache.generation()
+        setex = self.cache.client.setex
+        def delete_then_setex(*args):
+            self.cache.delete(1)
+            setex(*args)
+        with patch.object(self.cache.client, 'setex', delete_then_setex):
+            self.cache.set(1, 'old', generation)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, 'new', self.cache.generation())
+        self.assertEqual(self.cache.get(1), 'new')
+
+    def test_create_cache(self):
+        """ Create the backend named by the configuration """
+        self.assertIsInstance(create_cache({'CACHE_BACKEND': 'none'}), NullCache)
+        cache = create_cache({'CACHE_BACKEND': 'local', 'CACHE_SIZE': 5, 'CACHE_TTL': 1})
+        self.assertEqual((cache.maxsize, cache.ttl), (5, 1))
+        cache = create_cache({'CACHE_BACKEND': 'shared', 'CACHE_URL': 'memory://'})
+        self.assertIsInstance(cache.client, MemoryClient)
+        self.assertRaises(ValueError, create_cache, {'CACHE_BACKEND': 'disk'})
+
+    def test_local_cache_of_workers(self):
+        """ Refuse a local cache for several workers unless stale reads are fine """
+        self.assertIsInstance(create_cache({}), NullCache)
+        config = {'CACHE_BACKEND': 'local', 'WEB_CONCURRENCY': 3}
+        self.assertRaises(ValueError, create_cache, config)
+        config['CACHE_LOCAL_STALE_OK'] = True
+        self.assertIsInstance(create_cache(config), LocalCache)
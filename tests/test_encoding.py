@@ -0,0 +1,33 @@
+"""
+Test cases for the JSON Encoding of Order rows
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import unittest
+from service import encoding
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for encoding rows to JSON """
+
+    def test_encode_rows(self):
+        """ Encode rows as a JSON list of objects """
+        data = encoding.encode_rows(('id', 'status'), [(1, 'In Progress'), (2, 'Délivré')])
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data.decode('utf-8')),
+                         [{'id': 1, 'status': 'In Progress'}, {'id': 2, 'status': 'Délivré'}])
+        self.assertEqual(encoding.encode_rows(('id',), []), b'[]')
+
+    def test_encode_ndjson(self):
+        """ Encode rows as newline delimited JSON """
+        data = encoding.encode_ndjson(('id', 'uuid'), [(1, 'a'), (2, None)])
+        lines = data.decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'id': 1, 'uuid': 'a'}, {'id': 2, 'uuid': None}])
+        self.assertTrue(data.endswith(b'\n'))
@@ -0,0 +1,88 @@
+"""
+Test cases for the Gunicorn Configuration
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# the configuration exports its worker counts, keep them out of the tests
+with patch.dict(os.environ):
+    import gunicorn_config
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+@patch('os.sched_getaffinity', lambda pid: set(range(8)))
+class TestGunicornConfig(unittest.TestCase):
+    """ Test Cases for the worker sizing """
+
+    def setUp(self):
+        self.cgroup = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.cgroup, 'cpu'))
+        os.mkdir(os.path.join(self.cgroup, 'memory'))
+        patcher = patch.object(gunicorn_config, 'CGROUP', self.cgroup)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.cgroup)
+
+    def _write(self, name, value):
+        """ Writes a cgroup file """
+        with open(os.path.join(self.cgroup, name), 'w') as handle:
+            handle.write(value + '\n')
+
+    def test_cpus_without_limit(self):
+        """ Use every CPU when there is no quota """
+        self.assertEqual(gunicorn_config.cpu_limit(), 8)
+        self._write('cpu.max', 'max 100000')
+        self.assertEqual(gunicorn_config.cpu_limit(), 8)
+
+    def test_cpu_quota(self):
+        """ Round the CPU quota of cgroup v2 and v1 up """
+        self._write('cpu.max', '150000 100000')
+        self.assertEqual(gunicorn_config.cpu_limit(), 2)
+        os.remove(os.path.join(self.cgroup, 'cpu.max'))
+        self._write('cpu/cpu.cfs_quota_us', '50000')
+        self._write('cpu/cpu.cfs_period_us', '100000')
+        self.assertEqual(gunicorn_config.cpu_limit(), 1)
+
+    def test_memory_limit(self):
+        """ Read the memory limit of the cgroup or of MEMORY_LIMIT """
+        self.assertIsNone(gunicorn_config.memory_limit())
+        with patch.dict(os.environ, {'MEMORY_LIMIT': '512M'}):
+            self.assertEqual(gunicorn_config.memory_limit(), 512 * 1024 ** 2)
+        self._write('memory/memory.limit_in_bytes', str(2 ** 63 - 4096))
+        self.assertIsNone(gunicorn_config.memory_limit())
+        self._write('memory.max', str(256 * 1024 ** 2))
+        self.assertEqual(gunicorn_config.memory_limit(), 256 * 1024 ** 2)
+
+    def test_default_workers(self):
+        """ Run 2 workers per CPU + 1, as many as fit in memory """
+        self._write('cpu.max', '200000 100000')
+        self.assertEqual(gunicorn_config.default_workers(), 5)
+        self._write('memory.max', str(128 * 1024 ** 2))
+        self.assertEqual(gunicorn_config.default_workers(), 2)
+        self._write('memory.max', str(32 * 1024 ** 2))
+        self.assertEqual(gunicorn_config.default_workers(), 1)
+
+    def test_worker_threads(self):
+        """ Give every event stream a thread on top of those of the requests """
+        with patch.dict(os.environ, clear=True):
+            self.assertEqual(gunicorn_config.worker_threads('gthread'), (4, 16, 20))
+            self.assertEqual(gunicorn_config.worker_threads('sync'), (1, 0, 1))
+        with patch.dict(os.environ, {'WORKER_THREADS': '8', 'MAX_EVENT_STREAMS': '0'}):
+            self.assertEqual(gunicorn_config.worker_threads('gthread'), (8, 0, 8))
+            self.assertEqual(gunicorn_config.worker_threads('sync'), (8, 0, 1))
+
+    def test_sync_worker_streams(self):
+        """ Refuse event streams on the single thread of a sync worker """
+        with patch.dict(os.environ, {'MAX_EVENT_STREAMS': '1'}):
+            self.assertRaises(ValueError, gunicorn_config.worker_threads, 'sync')
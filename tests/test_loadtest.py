@@ -0,0 +1,50 @@
+"""
+Test cases for the Load Test reports
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from benchmarks.loadtest import percentile, statistics, compare
+
+def report(p95_ms, rps, requests=1000, errors=0):
+    """ Returns a report with one operation """
+    stats = {'requests': requests, 'errors': errors, 'rps': rps, 'p50_ms': p95_ms / 2,
+             'p95_ms': p95_ms, 'p99_ms': p95_ms * 2}
+    return {'total': stats, 'operations': {'get_order': stats}}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLoadTest(unittest.TestCase):
+    """ Test Cases for the statistics and comparisons of the load test """
+
+    def test_percentile(self):
+        """ Use the nearest rank of sorted latencies in milliseconds """
+        latencies = [n / 1000 for n in range(1, 101)]
+        self.assertEqual(percentile(latencies, 50), 50)
+        self.assertEqual(percentile(latencies, 99), 99)
+        self.assertEqual(percentile([0.002], 95), 2)
+        self.assertIsNone(percentile([], 50))
+
+    def test_statistics(self):
+        """ Summarize the requests of an operation """
+        stats = statistics([0.003, 0.001, 0.002, 0.004], 1, 2)
+        self.assertEqual(stats, {'requests': 4, 'errors': 1, 'rps': 2,
+                                 'p50_ms': 2, 'p95_ms': 4, 'p99_ms': 4})
+
+    def test_compare(self):
+        """ Report the operations that got slower or failed more """
+        self.assertEqual(compare(report(100, 50), report(110, 48), 15, 200), [])
+        self.assertEqual(compare(report(100, 50), report(120, 50), 15, 200),
+                         ['get_order', 'total'])
+        self.assertEqual(compare(report(100, 50), report(100, 40), 15, 200),
+                         ['get_order', 'total'])
+        self.assertEqual(compare(report(100, 50), report(100, 50, errors=3), 15, 200),
+                         ['get_order', 'total'])
+
+    def test_compare_few_requests(self):
+        """ Do not judge the operations measured too few times """
+        self.assertEqual(compare(report(100, 5, 50), report(200, 5, 50), 15, 200), [])
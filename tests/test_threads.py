@@ -0,0 +1,62 @@
+"""
+Test cases for the Background threads of the worker processes
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import unittest
+import threading
+from unittest.mock import patch
+from service.threads import PerProcessThread
+
+class Waiter(PerProcessThread):
+    """ A thread that runs until it is released """
+
+    name = 'waiter'
+
+    def __init__(self):
+        super(Waiter, self).__init__()
+        self.release = threading.Event()
+        self.starts = 0
+
+    def before_start(self):
+        self.starts += 1
+
+    def run(self):
+        self.release.wait(5)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPerProcessThread(unittest.TestCase):
+    """ Test Cases for the threads started once per process """
+
+    def setUp(self):
+        self.waiter = Waiter()
+
+    def tearDown(self):
+        self.waiter.release.set()
+        self.waiter.thread.join(5)
+        self.assertFalse(self.waiter.thread.is_alive())
+
+    def test_start_once(self):
+        """ Start a single daemon thread in a process """
+        self.waiter.start()
+        thread = self.waiter.thread
+        self.waiter.start()
+        self.assertIs(self.waiter.thread, thread)
+        self.assertEqual(self.waiter.starts, 1)
+        self.assertEqual(thread.name, 'waiter')
+        self.assertTrue(thread.daemon)
+
+    def test_start_after_fork(self):
+        """ Start the thread again in a forked process """
+        self.waiter.start()
+        first = self.waiter.thread
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            self.waiter.start()
+        self.assertIsNot(self.waiter.thread, first)
+        self.assertEqual(self.waiter.starts, 2)